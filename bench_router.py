@@ -0,0 +1,65 @@
+"""Micro-benchmark for link routing: python bench_router.py [messages]
+
+Compares the precompiled one-pass router (route_link) with the old per-message
+approach (recompile the URL regex, substring checks, urlparse for the cache key).
+"""
+from urllib.parse import urlparse, parse_qs
+import re
+import sys
+import time
+
+from video_bot import route_link
+
+SAMPLE_MESSAGES = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=Lx3h2k9",
+    "https://www.youtube.com/shorts/aqz-KE-bpKQ",
+    "https://m.youtube.com/watch?feature=share&v=9bZkp7q19f0",
+    "https://www.instagram.com/reel/DDSCZhbP0GW/?igsh=MTU5OWM3czUwdjN0eQ==",
+    "https://www.instagram.com/p/C1a2b3c4d5e/",
+    "https://www.instagram.com/share/reel/BAxyz123/",
+    "https://vimeo.com/76979871",
+    "hello bot, can you download this?",
+]
+
+# The routing code as it was before the precompiled router
+def legacy_route(text):
+    regex = re.compile(
+        r'^(?:http|ftp)s?://'
+        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'
+        r'localhost|'
+        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'
+        r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'
+        r'(?::\d+)?'
+        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+    if re.match(regex, text) is None:
+        return None
+    link = text.replace("youtube.com/shorts/", "youtube.com/watch?v=")
+    parsed = urlparse(link)
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if host == "youtu.be":
+        key = "youtube:" + parsed.path.strip("/")
+    elif host.endswith("youtube.com"):
+        key = "youtube:" + parse_qs(parsed.query).get("v", [""])[0]
+    elif "instagram.com" in link:
+        key = "instagram:" + parsed.path.rstrip("/").rsplit("/", 1)[-1]
+    else:
+        key = host + parsed.path
+    return link, key
+
+def bench(name, func, count):
+    messages = [SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)] for i in range(count)]
+    start = time.perf_counter()
+    for text in messages:
+        func(text)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {count / elapsed:>12,.0f} msgs/sec")
+    return count / elapsed
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    legacy = bench("legacy", legacy_route, count)
+    routed = bench("route_link", route_link, count)
+    print(f"speedup      {routed / legacy:>12.2f}x")
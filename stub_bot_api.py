@@ -0,0 +1,111 @@
+"""Stand-in for a self-hosted Telegram Bot API server: python stub_bot_api.py [port]
+
+Point the bot at it with BOT_API_BASE_URL=http://127.0.0.1:8081/bot (local mode is on by
+default). Every call is logged; sendVideo/sendAudio/sendDocument report whether the bot
+passed a local file:// path (and whether that file exists) or uploaded the bytes.
+Set STUB_FAIL_MEDIA=N to answer the first N media sends with a 502, to exercise retries.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse, unquote
+import itertools
+import json
+import os
+import sys
+import time
+
+MESSAGE_IDS = itertools.count(1)
+FILE_IDS = itertools.count(1)
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Stub", "username": "stub_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+MEDIA_METHODS = {"sendVideo": "video", "sendAudio": "audio", "sendDocument": "document"}
+MEDIA_FAILURES = {"remaining": int(os.getenv("STUB_FAIL_MEDIA", "0"))}
+
+def make_message(params: dict, **fields) -> dict:
+    chat_id = int(params.get("chat_id", 0))
+    message = {
+        "message_id": int(params.get("message_id") or next(MESSAGE_IDS)),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+    }
+    message.update(fields)
+    return message
+
+# Describe a media parameter and build the object Telegram would return for it
+def describe_media(value, upload_bytes: int) -> tuple:
+    file_object = {"file_id": f"stub-file-{next(FILE_IDS)}", "file_unique_id": f"u{next(FILE_IDS)}"}
+    if isinstance(value, str) and value.startswith("file://"):
+        path = unquote(urlparse(value).path)
+        if not os.path.isfile(path):
+            return f"local path {path} (missing)", None
+        file_object["file_size"] = os.path.getsize(path)
+        return f"local path {path} ({file_object['file_size']} bytes, nothing uploaded)", file_object
+    if upload_bytes:
+        file_object["file_size"] = upload_bytes
+        return f"uploaded {upload_bytes} bytes", file_object
+    return f"file_id/URL {value}", file_object
+
+def handle_method(method: str, params: dict, upload_bytes: int):
+    if method == "getMe":
+        return BOT_USER
+    if method in ("deleteWebhook", "setWebhook", "close", "logOut", "answerCallbackQuery", "deleteMessage"):
+        return True
+    if method == "getUpdates":
+        time.sleep(min(float(params.get("timeout") or 0), 1))
+        return []
+    if method in ("sendMessage", "editMessageText"):
+        return make_message(params, text=params.get("text", ""))
+    if method in MEDIA_METHODS:
+        kind = MEDIA_METHODS[method]
+        description, file_object = describe_media(params.get(kind), upload_bytes)
+        print(f"  {kind}: {description}", flush=True)
+        if file_object is None:
+            raise ValueError("Bad Request: file not found")
+        if kind == "video":
+            file_object.update(width=1280, height=720, duration=0)
+        elif kind == "audio":
+            file_object["duration"] = 0
+        return make_message(params, **{kind: file_object})
+    return True
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # Paths look like /bot<token>/<method>
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        content_type = self.headers.get("Content-Type", "")
+
+        upload_bytes = 0
+        if content_type.startswith("application/json"):
+            params = json.loads(body or b"{}")
+        elif content_type.startswith("multipart/form-data"):
+            params, upload_bytes = {}, len(body)
+        else:
+            params = dict(parse_qsl(body.decode()))
+        print(f"{method} {json.dumps({k: v for k, v in params.items() if k != 'text'})[:200]}", flush=True)
+
+        if method in MEDIA_METHODS and MEDIA_FAILURES["remaining"] > 0:
+            MEDIA_FAILURES["remaining"] -= 1
+            print("  injected failure: 502", flush=True)
+            reply = {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        else:
+            try:
+                reply = {"ok": True, "result": handle_method(method, params, upload_bytes)}
+            except ValueError as e:
+                reply = {"ok": False, "error_code": 400, "description": str(e)}
+        payload = json.dumps(reply).encode()
+        self.send_response(200 if reply["ok"] else reply["error_code"])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass  # do_POST already prints one line per call
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    print(f"Stub Bot API listening on http://127.0.0.1:{port}/bot", flush=True)
+    server.serve_forever()
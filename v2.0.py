@@ -3,13 +3,13 @@ from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQu
 from dotenv import load_dotenv
 from datetime import datetime
 import os
-import subprocess
 import logging
-import requests
+import httpx
 import re
 import uuid
 import json
 import asyncio
+import time
 
 
 # Load .env file
@@ -24,7 +24,7 @@ if not TELEGRAM_BOT_TOKEN:
 # Set up logging
 logging.basicConfig(level=logging.WARNING)
 
-# Temporary cache to store URLs and fetched formats
+# Temporary cache to store URLs and, per keyboard, the little of the video info the buttons need
 URL_CACHE = {}
 FORMAT_CACHE = {}
 FORMAT_QUALITY_MAPPING = {
@@ -124,19 +124,44 @@ def normalize_url(url: str) -> str:
         return url.replace("youtube.com/shorts/", "youtube.com/watch?v=")
     return url
 
-# Function to shorten URL using TinyURL
-def shorten_url(long_url: str) -> str:
+# URL shortener settings; short links are reused for an hour, well inside the signed URL lifetime
+SHORTENER_TIMEOUT = 3
+SHORT_URL_TTL = 3600
+SHORT_URL_CACHE_SIZE = 1024
+SHORT_URL_CACHE = {}  # long URL -> (expires_at, short URL)
+
+# One pooled HTTP client for the shortener, created on first use
+_http_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(SHORTENER_TIMEOUT))
+    return _http_client
+
+# Function to shorten URL using TinyURL; falls back to the original link if the service is slow or fails
+async def shorten_url(long_url: str) -> str:
+    cached = SHORT_URL_CACHE.get(long_url)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
     try:
-        response = requests.get(f"https://tinyurl.com/api-create.php?url={long_url}")
-        if response.status_code == 200:
-            return response.text
-        else:
+        response = await get_http_client().get("https://tinyurl.com/api-create.php", params={"url": long_url})
+        if response.status_code != 200:
             logging.error(f"Error shortening URL: {response.status_code}")
             return long_url
+    except httpx.TimeoutException:
+        logging.warning("URL shortener timed out, sending the original link")
+        return long_url
     except Exception as e:
         logging.error(f"Exception while shortening URL: {e}")
         return long_url
 
+    if len(SHORT_URL_CACHE) >= SHORT_URL_CACHE_SIZE:
+        SHORT_URL_CACHE.pop(next(iter(SHORT_URL_CACHE)))
+    SHORT_URL_CACHE[long_url] = (time.time() + SHORT_URL_TTL, response.text)
+    return response.text
+
 # Function to delete messages after expiration
 async def delete_expired_message(context: ContextTypes.DEFAULT_TYPE):
     job_data = context.job.data
@@ -161,33 +186,16 @@ async def send_download_link_with_expiration(chat_id: int, text: str, context, e
 # Function to generate and send the direct download link for Instagram
 async def send_instagram_download_link(chat_id: int, link: str, context):
     try:
-        command = ["yt-dlp", "-g", "-f", "best", link]
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        if result.returncode != 0:
+        # One extraction gives us both the direct link and the title/caption
+        video_info = await fetch_video_info(link, "best")
+        if not video_info:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-            logging.error(f"yt-dlp error: {result.stderr.strip()}")
             return
 
-        direct_link = result.stdout.strip()
+        direct_link = video_info.get('url')
         if direct_link:
-            short_link = shorten_url(direct_link)
-
-            # Fetch video info to get the title and caption
-            video_info_command = ["yt-dlp", "-j", "--cookies", "cookies.txt", link]
-            process = await asyncio.create_subprocess_exec(
-                *video_info_command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            video_info_stdout, video_info_stderr = await process.communicate()
-
-            if process.returncode != 0:
-                logging.error(f"Error fetching video info: {video_info_stderr.decode().strip()}")
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-                return
+            short_link = await shorten_url(direct_link)
 
-            video_info = json.loads(video_info_stdout.decode().strip())
             video_title = video_info['title']
             video_caption = video_info.get('description', 'No caption available')
 
@@ -216,10 +224,12 @@ async def send_instagram_download_link(chat_id: int, link: str, context):
         await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an unexpected error occurred.")
         logging.error(f"Unexpected error: {e}")
 
-# Function to fetch available formats for YouTube
-async def fetch_formats(url: str) -> list:
+# Function to fetch the video info for a link with a single `yt-dlp -j` call
+async def fetch_video_info(url: str, format_id: str = None) -> dict:
     try:
-        command = ["yt-dlp", "-F", "--cookies", "cookies.txt", url]
+        command = ["yt-dlp", "-j", "--cookies", "cookies.txt", url]
+        if format_id:
+            command[2:2] = ["-f", format_id]
         process = await asyncio.create_subprocess_exec(
             *command,
             stdout=asyncio.subprocess.PIPE,
@@ -231,53 +241,52 @@ async def fetch_formats(url: str) -> list:
             logging.error(f"yt-dlp error: {stderr.decode().strip()}")
             return None
 
-        formats = []
-        for line in stdout.decode().splitlines():
-            if re.match(r"^\d+", line):  # Format lines start with a number
-                parts = line.split()
-                format_id = parts[0]
-                resolution = " ".join(parts[1:])  # Combine remaining parts for resolution/quality
-                formats.append((format_id, resolution))
-        return formats
+        return json.loads(stdout.decode().strip())
     except Exception as e:
-        logging.error(f"Error fetching formats: {e}")
+        logging.error(f"Error fetching video info: {e}")
         return None
 
+# Function to list available formats for YouTube from the video info
+def fetch_formats(video_info: dict) -> list:
+    formats = []
+    for f in video_info.get('formats', []):
+        # Same fields as a `yt-dlp -F` row: extension, resolution and note
+        resolution = " ".join(str(f.get(key) or '') for key in ('ext', 'resolution', 'format_note'))
+        formats.append((f['format_id'], resolution))
+    return formats
+
+# The part of the video info a keyboard's buttons need: title, duration and the stream URL
+# of each offered format, so a click never re-runs `yt-dlp -j`
+def keyboard_video_info(video_info: dict, format_ids) -> dict:
+    format_ids = set(format_ids)
+    return {
+        'title': video_info.get('title'),
+        'duration': video_info.get('duration'),
+        'formats': [
+            {'format_id': f['format_id'], 'url': f.get('url')}
+            for f in video_info.get('formats', []) if f.get('format_id') in format_ids
+        ],
+    }
+
 # Function to generate and send the direct download link for YouTube
-async def send_youtube_download_link(format_id: str, chat_id: int, link: str, context, selected_quality: str):
+async def send_youtube_download_link(format_id: str, chat_id: int, link: str, context, selected_quality: str, video_info: dict = None):
     try:
-        # Fetch the direct download link
-        command = ["yt-dlp", "-g", "--cookies", "cookies.txt", "-f", format_id, link]
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
+        # Reuse the info extracted when the link came in; only extract if we don't have it
+        if video_info is None:
+            video_info = await fetch_video_info(link)
+            if not video_info:
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+                return
 
-        if process.returncode != 0:
-            logging.error(f"Error fetching download link: {stderr.decode().strip()}")
+        selected = next((f for f in video_info.get('formats', []) if f.get('format_id') == format_id), None)
+        if not selected or not selected.get('url'):
+            logging.error(f"Error fetching download link: format {format_id} not available")
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
             return
 
-        direct_link = stdout.decode().strip()
-        short_link = shorten_url(direct_link)
-
-        # Fetch video info to get the title and duration
-        video_info_command = ["yt-dlp", "-j", "--cookies", "cookies.txt", link]
-        process = await asyncio.create_subprocess_exec(
-            *video_info_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        video_info_stdout, video_info_stderr = await process.communicate()
-
-        if process.returncode != 0:
-            logging.error(f"Error fetching video info: {video_info_stderr.decode().strip()}")
-            await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-            return
+        direct_link = selected['url']
+        short_link = await shorten_url(direct_link)
 
-        video_info = json.loads(video_info_stdout.decode().strip())
         video_title = video_info['title']
         duration = video_info['duration']
 
@@ -318,7 +327,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
     else:
         message = await context.bot.send_message(chat_id=chat_id, text="🔍 Fetching available formats, please wait...")
-        formats = await fetch_formats(link)
+        video_info = await fetch_video_info(link)
+        formats = fetch_formats(video_info) if video_info else None
 
         if not formats:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Failed to fetch available formats. Please try again.", parse_mode='Markdown')
@@ -349,14 +359,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 message_id=message.message_id,
                 text=f"🎥 Using your default preference: *{default_quality}*. Generating download link..."
             )
-            await send_youtube_download_link(format_id, chat_id, link, context, default_quality)
+            await send_youtube_download_link(format_id, chat_id, link, context, default_quality, video_info)
             await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
             return
 
         # Cache unique ID and formats
         unique_id = str(uuid.uuid4())
         URL_CACHE[unique_id] = link
-        FORMAT_CACHE[unique_id] = filtered_formats
+        FORMAT_CACHE[unique_id] = keyboard_video_info(video_info, filtered_formats.values())
 
         # Generate buttons for available formats
         keyboard = []
@@ -441,7 +451,7 @@ async def handle_format_selection(update: Update, context: ContextTypes.DEFAULT_
 
         if unique_id in URL_CACHE:
             await context.bot.edit_message_text(chat_id=chat_id, message_id=query.message.message_id, text="📥 Generating your download link, please wait...", parse_mode='Markdown')
-            await send_youtube_download_link(format_code, chat_id, URL_CACHE[unique_id], context, selected_quality)
+            await send_youtube_download_link(format_code, chat_id, URL_CACHE[unique_id], context, selected_quality, FORMAT_CACHE.get(unique_id))
             await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
         else:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Error: Invalid selection. Please try again.", parse_mode='Markdown')
@@ -1,15 +1,32 @@
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton, Message
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from dotenv import load_dotenv
 from datetime import datetime
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from typing import NamedTuple
+from pathlib import Path
 import os
-import subprocess
 import logging
-import requests
+import httpx
 import re
 import uuid
 import json
 import asyncio
+import hashlib
+import itertools
+import shutil
+import socket
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import yt_dlp
+from yt_dlp.downloader import get_suitable_downloader
 
 
 # Load .env file
@@ -24,24 +41,207 @@ if not TELEGRAM_BOT_TOKEN:
 # Set up logging
 logging.basicConfig(level=logging.WARNING)
 
-# Temporary cache to store URLs and fetched formats
-URL_CACHE = {}
-FORMAT_CACHE = {}
-FORMAT_QUALITY_MAPPING = {
-    '18': '360p',
-    '22': '720p',
-    '37': '1080p',
-    '133': '240p',
-    '134': '360p',
-    '135': '480p',
-    '136': '720p',
-    '137': '1080p', # add more later 
+# Options shared by every in-process yt-dlp instance
+YDL_OPTIONS = {
+    'cookiefile': 'cookies.txt',
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'noplaylist': True,
 }
+EXTRACTOR_POOL_SIZE = int(os.getenv('EXTRACTOR_POOL_SIZE', '4'))
+DOWNLOAD_POOL_SIZE = int(os.getenv('DOWNLOAD_POOL_SIZE', '8'))
+
+# Metadata cache settings; the TTL must stay below the lifetime of the signed stream URLs
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '512'))
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', '1800'))
+SIGNED_URL_SAFETY_MARGIN = 300
+
+# URL shortener backend: tinyurl, bitly (uses BITLY_API_KEY), local (offline stand-in) or none
+SHORTENER = os.getenv('SHORTENER', 'tinyurl')
+SHORTENER_TIMEOUT = float(os.getenv('SHORTENER_TIMEOUT', '3'))
+SHORT_URL_CACHE_SIZE = 2048
+SHORT_URL_TTL = 3600
+
+# Pending format-selection keyboards; set SELECTION_SESSION_FILE to keep them across restarts
+SELECTION_CACHE_SIZE = int(os.getenv('SELECTION_CACHE_SIZE', '1000'))
+SELECTION_TTL = int(os.getenv('SELECTION_TTL', '3600'))
+SELECTION_SESSION_FILE = os.getenv('SELECTION_SESSION_FILE')
+SELECTION_FLUSH_INTERVAL = 30
+
+# Download job scheduler limits
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '3'))
+MAX_DOWNLOADS_PER_USER = int(os.getenv('MAX_DOWNLOADS_PER_USER', '2'))
+SCHEDULER_AGING_RATE = 10  # cost units a queued job gains per second waited, so long jobs never starve
+
+# Live progress in the status message: at most one edit per chat every PROGRESS_EDIT_INTERVAL seconds
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '3'))
+
+# ffmpeg merges are CPU bound; by default run one per core
+MERGE_CONCURRENCY = int(os.getenv('MERGE_CONCURRENCY', str(os.cpu_count() or 1)))
+
+# "stream" pipes both downloads straight into ffmpeg through FIFOs so only the merged
+# file touches disk; "disk" keeps the old download-then-merge flow
+MERGE_PIPELINE = os.getenv('MERGE_PIPELINE', 'stream')
+
+# Per-job scratch directories; point WORKSPACE_ROOT at a tmpfs (e.g. /dev/shm/studysync) to keep jobs in RAM
+WORKSPACE_ROOT = os.getenv('WORKSPACE_ROOT', 'downloads')
+WORKSPACE_QUOTA_BYTES = int(os.getenv('WORKSPACE_QUOTA_MB', '2048')) * 1024 * 1024
+
+# Finished merged videos kept on disk for reuse across chats
+ARTIFACT_CACHE_DIR = os.getenv('ARTIFACT_CACHE_DIR', 'artifact_cache')
+ARTIFACT_CACHE_BYTES = int(os.getenv('ARTIFACT_CACHE_MB', '5120')) * 1024 * 1024
+ARTIFACT_STALE_TMP_AGE = 3600  # seconds before a half-published file counts as abandoned
+
+# Optional self-hosted Bot API server (telegram-bot-api --local), e.g. http://localhost:8081/bot.
+# In local mode deliveries pass a file path the server reads itself instead of uploading bytes,
+# so the server must see the same filesystem paths as the bot.
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL')
+BOT_API_BASE_FILE_URL = os.getenv('BOT_API_BASE_FILE_URL')
+BOT_API_LOCAL_MODE = bool(BOT_API_BASE_URL) and os.getenv('BOT_API_LOCAL_MODE', 'true').lower() in ('1', 'true', 'yes')
+
+# Webhook mode: set WEBHOOK_URL to the public https base URL and Telegram pushes updates to
+# WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH instead of the bot long-polling (needs
+# python-telegram-bot[webhooks]). Telegram sends WEBHOOK_SECRET_TOKEN with every update, and
+# updates not carrying it are rejected.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # concurrent deliveries, 1-100
+
+# Largest file the Bot API accepts from send_video (50 MB, or 2000 MB through a local server);
+# jobs predicted to be bigger get links instead
+TELEGRAM_UPLOAD_LIMIT_BYTES = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', '2000' if BOT_API_LOCAL_MODE else '50')) * 1024 * 1024
+MERGE_OVERHEAD = 1.02  # mp4 container overhead on top of the summed stream sizes
+
+# Uploads stream the file in chunks (memory per upload stays at one chunk); a dropped
+# connection or a 429/5xx is retried with exponential backoff
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', '3'))
+UPLOAD_BACKOFF = 2  # seconds before the first retry, doubled for each further one
+UPLOAD_TIMEOUT = httpx.Timeout(connect=10, read=300, write=60, pool=30)
+
+# Bounded LRU cache whose entries expire after a TTL
+class TTLCache:
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (self.clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# Extracted metadata (formats, title, caption, stream URLs) keyed by platform + video ID
+METADATA_CACHE = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+# Selection sessions behind the format keyboards, optionally spilled to a JSON file.
+# Expiry uses wall-clock time so entries loaded after a restart keep their deadline.
+class SelectionStore(TTLCache):
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_entries: int, ttl: float, path: str = None):
+        super().__init__(max_entries, ttl)
+        self.path = path
+        self._dirty = False
+
+    def set(self, key, value, ttl: float = None):
+        super().set(key, value, ttl)
+        self._dirty = True
+
+    def pop(self, key, default=None):
+        self._dirty = True
+        return super().pop(key, default)
+
+    # Load sessions saved by a previous run, dropping the ones that have expired
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logging.error(f"Ignoring corrupt selection session file: {self.path}")
+            return
+
+        now = self.clock()
+        for key, (expires_at, value) in saved.items():
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Copy of the live sessions if anything changed since the last flush, else None
+    def snapshot(self) -> dict:
+        if not self.path or not self._dirty:
+            return None
+        self._dirty = False
+        now = self.clock()
+        return {key: entry for key, entry in self._entries.items() if entry[0] > now}
 
-# File path for download history
+    # Atomically write a snapshot to disk
+    def write(self, snapshot: dict):
+        if snapshot is None:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temp_path, self.path)
+
+    def flush(self):
+        self.write(self.snapshot())
+
+# Pending keyboards: unique ID -> {"link": ..., "formats": {quality: format_id}}
+SELECTION_SESSIONS = SelectionStore(SELECTION_CACHE_SIZE, SELECTION_TTL, SELECTION_SESSION_FILE)
+
+# Download history lives in SQLite; the old JSON file is imported into it once
+HISTORY_DB = os.getenv('HISTORY_DB', 'download_history.db')
 HISTORY_FILE = "download_history.json"
+HISTORY_LIMIT = 10  # downloads kept per user
+
+# All history queries run on one thread that owns the connection, which also serializes writes
+HISTORY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+_history_local = threading.local()
 
-# Load history from file
+# Load the legacy history JSON file
 def load_history() -> dict:
     try:
         with open(HISTORY_FILE, "r") as file:
@@ -51,29 +251,192 @@ def load_history() -> dict:
     except json.JSONDecodeError:
         return {}
 
-# Save history to file
-def save_history(history: dict):
-    with open(HISTORY_FILE, "w") as file:
-        json.dump(history, file, indent=4)
+# Open the history database on the history thread, creating the schema on first use
+def _history_db() -> sqlite3.Connection:
+    connection = getattr(_history_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(HISTORY_DB)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                format TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user_id, timestamp);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        _history_local.connection = connection
+        _import_history_json(connection)
+    return connection
+
+# One-shot import of download_history.json; recorded in the meta table so it never runs twice
+def _import_history_json(connection: sqlite3.Connection):
+    if connection.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
+
+    rows = [
+        (int(user_id), entry["url"], entry["format"], entry["timestamp"])
+        for user_id, entries in load_history().items()
+        for entry in entries
+    ]
+    with connection:
+        connection.executemany("INSERT INTO history (user_id, url, format, timestamp) VALUES (?, ?, ?, ?)", rows)
+        connection.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (str(len(rows)),))
+    if rows:
+        logging.info(f"Imported {len(rows)} history entries from {HISTORY_FILE}")
+
+def _add_to_history_sync(user_id: int, url: str, format: str, timestamp: str):
+    connection = _history_db()
+    with connection:
+        connection.execute(
+            "INSERT INTO history (user_id, url, format, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, url, format, timestamp)
+        )
+        # Limit history to the last HISTORY_LIMIT downloads per user; the index keeps this to a few rows
+        connection.execute(
+            "DELETE FROM history WHERE user_id = ? AND id NOT IN "
+            "(SELECT id FROM history WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?)",
+            (user_id, user_id, HISTORY_LIMIT)
+        )
 
-# Add a new entry to a user's history
+def _fetch_history_page_sync(user_id: int, offset: int, limit: int) -> tuple:
+    connection = _history_db()
+    total = connection.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,)).fetchone()[0]
+    rows = connection.execute(
+        "SELECT url, format, timestamp FROM history WHERE user_id = ? "
+        "ORDER BY timestamp, id LIMIT ? OFFSET ?",
+        (user_id, limit, offset)
+    ).fetchall()
+    return [{"url": url, "format": format, "timestamp": timestamp} for url, format, timestamp in rows], total
+
+def _log_history_error(future):
+    if future.exception():
+        logging.error(f"Failed to record history: {future.exception()}")
+
+# Add a new entry to a user's history; the write happens in the background
 def add_to_history(user_id: int, url: str, format: str):
-    history = load_history()
-    if str(user_id) not in history:
-        history[str(user_id)] = []
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    future = HISTORY_EXECUTOR.submit(_add_to_history_sync, user_id, url, format, timestamp)
+    future.add_done_callback(_log_history_error)
+
+# Fetch one page of a user's history, oldest first; returns (entries, total entries)
+async def fetch_history_page(user_id: int, page: int, items_per_page: int) -> tuple:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(HISTORY_EXECUTOR, _fetch_history_page_sync, user_id, page * items_per_page, items_per_page)
+
+# Roles: "standalone" answers updates and runs downloads in one process (the default);
+# "frontend" only answers updates and queues downloads; "worker" runs queued downloads.
+# Frontend and workers share the SQLite job queue at JOB_QUEUE_DB.
+BOT_ROLE = os.getenv('BOT_ROLE', 'standalone')
+JOB_QUEUE_DB = os.getenv('JOB_QUEUE_DB', 'jobs.db')
+JOB_POLL_INTERVAL = 1  # seconds between queue checks when idle
+JOB_LEASE = 60  # a running job whose worker misses heartbeats this long is handed to another worker
+JOB_MAX_ATTEMPTS = 3
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', str(MAX_CONCURRENT_DOWNLOADS)))
+
+# Queue queries run on one thread per process, like history; processes coordinate through SQLite locks
+JOB_QUEUE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+_job_queue_local = threading.local()
+
+def _job_queue_db() -> sqlite3.Connection:
+    connection = getattr(_job_queue_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                link TEXT NOT NULL,
+                format_id TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                status_message_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',  -- queued, running, done, failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                heartbeat REAL,
+                file_id TEXT,
+                error TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id);
+        """)
+        _job_queue_local.connection = connection
+    return connection
+
+def _enqueue_job_sync(chat_id: int, link: str, format_id: str, quality: str, status_message_id: int) -> int:
+    cursor = _job_queue_db().execute(
+        "INSERT INTO jobs (chat_id, link, format_id, quality, status_message_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (chat_id, link, format_id, quality, status_message_id, time.time())
+    )
+    return cursor.lastrowid
+
+# Claim the oldest queued job for this worker. Jobs of workers that stopped heartbeating are
+# requeued first, or failed once they have used up their attempts.
+def _claim_job_sync(worker_id: str) -> dict:
+    connection = _job_queue_db()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+            "worker = NULL, error = 'worker stopped responding' WHERE state = 'running' AND heartbeat < ?",
+            (JOB_MAX_ATTEMPTS, now - JOB_LEASE)
+        )
+        row = connection.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now, row["id"])
+            )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return dict(row) if row is not None else None
+
+def _heartbeat_jobs_sync(worker_id: str, job_ids: list):
+    _job_queue_db().executemany(
+        "UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+        [(time.time(), job_id, worker_id) for job_id in job_ids]
+    )
 
-    # Add new entry
-    history[str(user_id)].append({
-        "url": url,
-        "format": format,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
+def _finish_job_sync(job_id: int, worker_id: str, state: str, file_id: str, error: str):
+    _job_queue_db().execute(
+        "UPDATE jobs SET state = ?, file_id = ?, error = ? WHERE id = ? AND worker = ?",
+        (state, file_id, error, job_id, worker_id)
+    )
 
-    # Limit history to the last 10 downloads per user
-    history[str(user_id)] = history[str(user_id)][-10:]
-    save_history(history)
+# Take every finished job off the queue; the front end reports them to their chats
+def _collect_finished_jobs_sync() -> list:
+    connection = _job_queue_db()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        rows = connection.execute("SELECT * FROM jobs WHERE state IN ('done', 'failed') ORDER BY id").fetchall()
+        connection.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return [dict(row) for row in rows]
+
+async def run_job_queue(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(JOB_QUEUE_EXECUTOR, func, *args)
 
 PREFERENCE_FILE = "user_preferences.json"
+PREFERENCE_FLUSH_INTERVAL = 5  # seconds between background writes of changed preferences
+
+# Preferences are held in memory; changes are written to disk in the background
+PREFERENCES = None
+PREFERENCES_DIRTY = False
+PREFERENCE_SAVE_LOCK = asyncio.Lock()
 
 # Load preferences from file
 def load_preferences() -> dict:
@@ -85,58 +448,442 @@ def load_preferences() -> dict:
     except json.JSONDecodeError:
         return {}
 
-# Save preferences to file
+# Save preferences to file, atomically so a crash never leaves it half written
 def save_preferences(preferences: dict):
-    with open(PREFERENCE_FILE, "w") as file:
+    temp_path = f"{PREFERENCE_FILE}.tmp"
+    with open(temp_path, "w") as file:
         json.dump(preferences, file, indent=4)
+    os.replace(temp_path, PREFERENCE_FILE)
+
+# The in-memory preferences, loaded from disk the first time they are needed
+def get_preferences() -> dict:
+    global PREFERENCES
+    if PREFERENCES is None:
+        PREFERENCES = load_preferences()
+    return PREFERENCES
 
 # Set a user's preference
 def set_user_preference(user_id: int, preference_key: str, preference_value: str):
-    preferences = load_preferences()
+    global PREFERENCES_DIRTY
+    preferences = get_preferences()
     if str(user_id) not in preferences:
         preferences[str(user_id)] = {}
     preferences[str(user_id)][preference_key] = preference_value
-    save_preferences(preferences)
+    PREFERENCES_DIRTY = True
+
+# Delete a user's preference; returns False if it was not set
+def delete_user_preference(user_id: int, preference_key: str) -> bool:
+    global PREFERENCES_DIRTY
+    user_preferences = get_preferences().get(str(user_id), {})
+    if preference_key not in user_preferences:
+        return False
+    del user_preferences[preference_key]
+    PREFERENCES_DIRTY = True
+    return True
 
 # Get a user's preference
 def get_user_preference(user_id: int, preference_key: str = None, default_value: str = None) -> str:
-    preferences = load_preferences()
+    preferences = get_preferences()
     if preference_key:
         return preferences.get(str(user_id), {}).get(preference_key, default_value)
     return preferences.get(str(user_id), default_value)
 
-# Function to validate YouTube and Instagram links
-def is_valid_link(url: str) -> bool:
-    regex = re.compile(
-        r'^(?:http|ftp)s?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
-        r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    
-    return re.match(regex, url) is not None
-
-# Normalize YouTube Shorts URL
-def normalize_url(url: str) -> str:
-    if "youtube.com/shorts/" in url:
-        return url.replace("youtube.com/shorts/", "youtube.com/watch?v=")
-    return url
-
-# Function to shorten URL using TinyURL
-def shorten_url(long_url: str) -> str:
+# Copy of the preferences if they changed since the last flush, else None
+def _preferences_snapshot() -> dict:
+    global PREFERENCES_DIRTY
+    if not PREFERENCES_DIRTY:
+        return None
+    PREFERENCES_DIRTY = False
+    return {user_id: dict(values) for user_id, values in get_preferences().items()}
+
+# Write changed preferences to disk off the event loop; batches every change since the last flush
+async def flush_preferences(context: ContextTypes.DEFAULT_TYPE = None):
+    async with PREFERENCE_SAVE_LOCK:
+        snapshot = _preferences_snapshot()
+        if snapshot is not None:
+            await asyncio.to_thread(save_preferences, snapshot)
+
+# File path for Telegram file_ids of media we already delivered
+FILE_ID_CACHE_FILE = "file_id_cache.json"
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '10000'))
+FILE_ID_FLUSH_INTERVAL = 10  # seconds between background writes of changed file_ids
+
+# "platform:video_id|format_id" -> Telegram file_id, least recently used first; loaded in main().
+# Changes are written to disk in the background, like preferences.
+FILE_ID_CACHE = OrderedDict()
+FILE_ID_CACHE_DIRTY = False
+FILE_ID_SAVE_LOCK = asyncio.Lock()
+
+# Load delivered file_ids from file
+def load_file_ids() -> dict:
+    try:
+        with open(FILE_ID_CACHE_FILE, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        return {}
+
+# Save delivered file_ids to file, atomically so a crash never leaves it half written
+def save_file_ids(file_ids: dict):
+    temp_path = f"{FILE_ID_CACHE_FILE}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(file_ids, file, indent=4)
+    os.replace(temp_path, FILE_ID_CACHE_FILE)
+
+def file_id_key(link: str, format_id: str) -> str:
+    return f"{video_cache_key(link)}|{format_id}"
+
+# Copy of the file_id cache if it changed since the last flush, else None.
+# Only one process owns the file: workers keep their file_ids in memory and report them
+# through the jobs table, and the frontend records them in collect_finished_jobs.
+def _file_ids_snapshot() -> dict:
+    global FILE_ID_CACHE_DIRTY
+    if not FILE_ID_CACHE_DIRTY or BOT_ROLE == "worker":
+        return None
+    FILE_ID_CACHE_DIRTY = False
+    return dict(FILE_ID_CACHE)
+
+# Write changed file_ids off the event loop, one save at a time so a stale copy never wins
+async def flush_file_ids(context: ContextTypes.DEFAULT_TYPE = None):
+    async with FILE_ID_SAVE_LOCK:
+        snapshot = _file_ids_snapshot()
+        if snapshot is not None:
+            await asyncio.to_thread(save_file_ids, snapshot)
+
+# Drop the least recently used file_ids beyond FILE_ID_CACHE_SIZE
+def _trim_file_ids():
+    while len(FILE_ID_CACHE) > FILE_ID_CACHE_SIZE:
+        FILE_ID_CACHE.popitem(last=False)
+
+def get_file_id(link: str, format_id: str) -> str:
+    key = file_id_key(link, format_id)
+    file_id = FILE_ID_CACHE.get(key)
+    if file_id is not None:
+        FILE_ID_CACHE.move_to_end(key)
+    return file_id
+
+# Remember the file_id Telegram returned for an upload
+def remember_file_id(link: str, format_id: str, file_id: str):
+    global FILE_ID_CACHE_DIRTY
+    key = file_id_key(link, format_id)
+    FILE_ID_CACHE[key] = file_id
+    FILE_ID_CACHE.move_to_end(key)
+    _trim_file_ids()
+    FILE_ID_CACHE_DIRTY = True
+
+# Forget a file_id Telegram no longer accepts
+def forget_file_id(link: str, format_id: str):
+    global FILE_ID_CACHE_DIRTY
+    if FILE_ID_CACHE.pop(file_id_key(link, format_id), None) is not None:
+        FILE_ID_CACHE_DIRTY = True
+
+# Re-send a previously delivered video by file_id; returns False if there is nothing to re-send
+async def send_cached_video(chat_id: int, link: str, format_id: str, context, selected_quality: str) -> bool:
+    file_id = get_file_id(link, format_id)
+    if not file_id:
+        return False
+
+    try:
+        if is_audio_job(format_id):
+            await context.bot.send_audio(chat_id=chat_id, audio=file_id, caption=audio_caption(format_id), parse_mode='Markdown')
+        else:
+            await context.bot.send_video(
+                chat_id=chat_id,
+                video=file_id,
+                caption=f"🎥 *Merged Video*\n📺 Quality: *{selected_quality}*\n\n",
+                parse_mode='Markdown'
+            )
+    except BadRequest as e:
+        logging.warning(f"Cached file_id rejected, downloading again: {e}")
+        forget_file_id(link, format_id)
+        return False
+    except TelegramError as e:
+        # Timeouts and network errors say nothing about the file_id; keep it for next time
+        logging.warning(f"Failed to send cached file_id, downloading again: {e}")
+        return False
+
+    add_to_history(chat_id, link, format_id)
+    return True
+
+# Upload a merged video file to a chat and remember its file_id for next time
+async def deliver_video_file(chat_id: int, link: str, format_id: str, path: str, context, selected_quality: str):
+    caption = f"🎥 *Merged Video*\n📺 Quality: *{selected_quality}*\n\n"
+    if BOT_API_LOCAL_MODE:
+        # The local server reads the file from disk; python-telegram-bot sends it as a file:// URI
+        sent_message = await context.bot.send_video(chat_id=chat_id, video=Path(path).absolute(), caption=caption, parse_mode='Markdown')
+    else:
+        # Streamed from disk rather than read into memory by the library
+        sent_message = await stream_upload(context.bot, "sendVideo", "video", path, {
+            "chat_id": chat_id, "caption": caption, "parse_mode": "Markdown", "supports_streaming": "true"
+        })
+
+    # Telegram may file large videos as documents
+    sent_media = sent_message.video or sent_message.document
+    if sent_media:
+        remember_file_id(link, format_id, sent_media.file_id)
+
+def audio_caption(job_id: str) -> str:
+    audio_format = job_id[len(AUDIO_JOB_PREFIX):]
+    return f"🎵 *Audio*\n🎧 Format: *{audio_format.upper() if audio_format in AUDIO_OUTPUTS else 'Original'}*\n\n"
+
+# Upload an audio file with send_audio and remember its file_id under the audio job ID
+async def deliver_audio_file(chat_id: int, link: str, job_id: str, path: str, context, video_info: dict, mime_type: str):
+    params = {
+        "chat_id": chat_id,
+        "caption": audio_caption(job_id),
+        "parse_mode": "Markdown",
+        "title": video_info.get('title'),
+        "performer": video_info.get('uploader'),
+        "duration": int(video_info['duration']) if video_info.get('duration') else None,
+    }
+    if BOT_API_LOCAL_MODE:
+        sent_message = await context.bot.send_audio(audio=Path(path).absolute(), **params)
+    else:
+        sent_message = await stream_upload(context.bot, "sendAudio", "audio", path, params, content_type=mime_type)
+
+    sent_media = sent_message.audio or sent_message.document
+    if sent_media:
+        remember_file_id(link, job_id, sent_media.file_id)
+
+# Upload a cached merged video if we have one; returns False if there is nothing cached
+async def send_cached_artifact(chat_id: int, link: str, format_id: str, context, selected_quality: str) -> bool:
+    cached_path = ARTIFACT_CACHE.get(file_id_key(link, format_id))
+    if not cached_path:
+        return False
     try:
-        response = requests.get(f"https://tinyurl.com/api-create.php?url={long_url}")
-        if response.status_code == 200:
-            return response.text
+        await deliver_video_file(chat_id, link, format_id, cached_path, context, selected_quality)
+    except FileNotFoundError:
+        return False  # evicted between lookup and upload
+
+    add_to_history(chat_id, link, format_id)
+    return True
+
+# Generic URL shape, for links on sites other than YouTube and Instagram
+URL_REGEX = re.compile(
+    r'^(?:http|ftp)s?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
+    r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# Every YouTube and Instagram URL layout we accept, classified and ID-extracted in one match
+LINK_ROUTER_REGEX = re.compile(r"""
+    ^https?://
+    (?:
+        (?:www\.|m\.|music\.)?(?:youtube\.com|youtube-nocookie\.com)/
+        (?:watch/?\?(?:[^#]*?&)?v=|shorts/|embed/|live/|v/)
+        (?P<youtube>[\w-]{11})(?![\w-])
+      |
+        youtu\.be/(?P<youtu_be>[\w-]{11})(?![\w-])
+      |
+        (?P<instagram>(?:www\.|m\.)?instagram\.com)(?=[/?#:]|$)
+    )
+""", re.VERBOSE | re.IGNORECASE)
+
+# Instagram posts that get a canonical URL. share/ links carry a share code rather than the
+# post ID and stories/ have their own layout, so both are passed on to yt-dlp as they are.
+INSTAGRAM_POST_REGEX = re.compile(
+    r'^https?://[^/]+/(?:(?!share/|stories/)[\w.]+/)?(?P<kind>reels?|p|tv)/(?P<post_id>[\w-]+)',
+    re.IGNORECASE
+)
+
+# A routed link: platform, video/post ID, canonical URL and the cache/dedup key
+LinkRoute = namedtuple("LinkRoute", "platform video_id url key")
+
+# Classify a link and extract its video ID; returns None if it is not a usable URL.
+# Tracking parameters (si, igsh, feature, ...) are dropped from the canonical URL.
+def route_link(url: str) -> LinkRoute:
+    url = url.strip()
+    match = LINK_ROUTER_REGEX.match(url)
+    if match:
+        video_id = match.group("youtube") or match.group("youtu_be")
+        if video_id:
+            return LinkRoute("youtube", video_id, f"https://www.youtube.com/watch?v={video_id}", f"youtube:{video_id}")
+
+        # Every instagram.com link goes to Instagram, whether or not it is a post we can canonicalise
+        post = INSTAGRAM_POST_REGEX.match(url)
+        if not post:
+            url = url.split("#", 1)[0]
+            return LinkRoute("instagram", url, url, f"instagram:{url}")
+        post_id = post.group("post_id")
+        kind = "p" if post.group("kind").lower() == "p" else "reel"
+        return LinkRoute("instagram", post_id, f"https://www.instagram.com/{kind}/{post_id}/", f"instagram:{post_id}")
+
+    if URL_REGEX.match(url):
+        canonical = url.split("#", 1)[0]
+        return LinkRoute("web", canonical, canonical, f"web:{canonical}")
+    return None
+
+# Build a cache key from the platform and video ID so different URLs of one video share an entry
+def video_cache_key(url: str) -> str:
+    route = route_link(url)
+    return route.key if route else url
+
+# Seconds until the signed stream URLs in an info dict stop working, if they say so
+def signed_url_lifetime(video_info: dict) -> float:
+    for f in video_info.get('formats') or [video_info]:
+        query = parse_qs(urlparse(f.get('url') or '').query)
+        try:
+            if 'expire' in query:  # YouTube: unix timestamp
+                return int(query['expire'][0]) - time.time()
+            if 'oe' in query:  # Instagram CDN: hex unix timestamp
+                return int(query['oe'][0], 16) - time.time()
+        except ValueError:
+            continue
+    return None
+
+# URL shortener backends. Each one returns the short URL or raises on failure.
+class TinyURLShortener:
+    async def shorten(self, client: httpx.AsyncClient, long_url: str) -> str:
+        response = await client.get("https://tinyurl.com/api-create.php", params={"url": long_url})
+        response.raise_for_status()
+        return response.text.strip()
+
+class BitlyShortener:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    async def shorten(self, client: httpx.AsyncClient, long_url: str) -> str:
+        response = await client.post(
+            "https://api-ssl.bitly.com/v4/shorten",
+            json={"long_url": long_url},
+            headers={"Authorization": f"Bearer {self.api_key}"}
+        )
+        response.raise_for_status()
+        return response.json()["link"]
+
+# Offline stand-in for tests and local runs: hands out stable fake short links
+class LocalShortener:
+    def __init__(self, base_url: str = "https://short.local"):
+        self.base_url = base_url
+        self.links = {}  # short code -> long URL
+
+    async def shorten(self, client: httpx.AsyncClient, long_url: str) -> str:
+        code = hashlib.sha1(long_url.encode()).hexdigest()[:8]
+        self.links[code] = long_url
+        return f"{self.base_url}/{code}"
+
+def make_shortener(name: str):
+    if name == "bitly":
+        if not BITLY_API_KEY:
+            raise ValueError("SHORTENER=bitly requires BITLY_API_KEY in .env file")
+        return BitlyShortener(BITLY_API_KEY)
+    if name == "local":
+        return LocalShortener()
+    if name == "none":
+        return None
+    return TinyURLShortener()
+
+URL_SHORTENER = make_shortener(SHORTENER)
+
+# Short links by long URL; an entry never outlives the signed URL it points to
+SHORT_URL_CACHE = TTLCache(SHORT_URL_CACHE_SIZE, SHORT_URL_TTL)
+
+# One pooled HTTP client for outgoing API calls, created on first use
+_http_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(SHORTENER_TIMEOUT),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return _http_client
+
+# Uploads get their own client: long timeouts, and they never queue behind shortener calls
+_upload_client = None
+
+def get_upload_client() -> httpx.AsyncClient:
+    global _upload_client
+    if _upload_client is None:
+        _upload_client = httpx.AsyncClient(timeout=UPLOAD_TIMEOUT, limits=httpx.Limits(max_connections=MAX_CONCURRENT_DOWNLOADS * 2))
+    return _upload_client
+
+async def close_http_client():
+    global _http_client, _upload_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _upload_client is not None:
+        await _upload_client.aclose()
+        _upload_client = None
+
+# Totals for /cachestats; throughput is bytes over time spent in successful attempts
+UPLOAD_STATS = {"uploads": 0, "bytes": 0, "seconds": 0.0, "retries": 0, "failures": 0}
+
+# Send a file with a Bot API media method (sendVideo, ...), streaming it from disk.
+# The Bot API has no partial uploads, so a retry sends the file again from the start.
+async def stream_upload(bot, method: str, field: str, path: str, params: dict, content_type: str = 'video/mp4') -> Message:
+    url = f"{bot.base_url}/{method}"
+    size = os.path.getsize(path)
+    form = {key: str(value) for key, value in params.items() if value is not None}
+
+    for attempt in range(UPLOAD_RETRIES + 1):
+        delay = UPLOAD_BACKOFF * 2 ** attempt
+        started = time.monotonic()
+        try:
+            with open(path, 'rb') as media_file:
+                response = await get_upload_client().post(url, data=form, files={field: (os.path.basename(path), media_file, content_type)})
+        except httpx.TransportError as e:
+            error = f"{type(e).__name__}: {e}"
         else:
-            logging.error(f"Error shortening URL: {response.status_code}")
-            return long_url
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {"description": f"HTTP {response.status_code}"}
+            if payload.get('ok'):
+                elapsed = time.monotonic() - started
+                UPLOAD_STATS["uploads"] += 1
+                UPLOAD_STATS["bytes"] += size
+                UPLOAD_STATS["seconds"] += elapsed
+                logging.info(f"Uploaded {size} bytes in {elapsed:.1f}s ({size / max(elapsed, 1e-6) / 1024 / 1024:.2f} MB/s)")
+                return Message.de_json(payload['result'], bot)
+
+            error = payload.get('description') or f"HTTP {response.status_code}"
+            if response.status_code != 429 and response.status_code < 500:
+                UPLOAD_STATS["failures"] += 1
+                raise TelegramError(error)
+            delay = (payload.get('parameters') or {}).get('retry_after') or delay
+
+        if attempt == UPLOAD_RETRIES:
+            break
+        UPLOAD_STATS["retries"] += 1
+        logging.warning(f"Upload attempt {attempt + 1} failed ({error}), retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+    UPLOAD_STATS["failures"] += 1
+    raise TelegramError(f"Upload failed after {UPLOAD_RETRIES + 1} attempts: {error}")
+
+# Function to shorten a URL; falls back to the original link if the service is slow or fails
+async def shorten_url(long_url: str) -> str:
+    if URL_SHORTENER is None:
+        return long_url
+
+    short_url = SHORT_URL_CACHE.get(long_url)
+    if short_url:
+        return short_url
+
+    try:
+        short_url = await asyncio.wait_for(URL_SHORTENER.shorten(get_http_client(), long_url), SHORTENER_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("URL shortener timed out, sending the original link")
+        return long_url
     except Exception as e:
         logging.error(f"Exception while shortening URL: {e}")
         return long_url
 
+    ttl = SHORT_URL_CACHE.ttl
+    lifetime = signed_url_lifetime({'url': long_url})
+    if lifetime is not None:
+        ttl = min(ttl, lifetime - SIGNED_URL_SAFETY_MARGIN)
+    if ttl > 0:
+        SHORT_URL_CACHE.set(long_url, short_url, ttl)
+    return short_url
+
 # Function to delete messages after expiration
 async def delete_expired_message(context: ContextTypes.DEFAULT_TYPE):
     job_data = context.job.data
@@ -158,38 +905,545 @@ async def send_download_link_with_expiration(chat_id: int, text: str, context, e
         data={"chat_id": chat_id, "message_id": message.message_id},
     )
 
+# Raised when a job writes more than its workspace quota allows
+class WorkspaceQuotaExceeded(yt_dlp.utils.DownloadError):
+    pass
+
+# A private scratch directory for one job, with a byte quota. The directory is removed
+# when the with-block exits, whether the job succeeded, failed or was cancelled.
+class JobWorkspace:
+    def __init__(self, root: str = WORKSPACE_ROOT, quota_bytes: int = WORKSPACE_QUOTA_BYTES):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.path = None
+        self._charges = {}  # file -> bytes written so far
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="job-", dir=self.root)
+        return self
+
+    def __exit__(self, *_):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def used(self) -> int:
+        with self._lock:
+            return sum(self._charges.values())
+
+    def remaining(self) -> int:
+        return max(self.quota_bytes - self.used(), 0)
+
+    # Record that `name` now holds nbytes; called from download threads as data arrives
+    def charge(self, name: str, nbytes: int):
+        with self._lock:
+            self._charges[name] = nbytes
+            used = sum(self._charges.values())
+        if used > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(f"Job exceeded its {self.quota_bytes // (1024 * 1024)} MB workspace quota")
+
+# On-disk cache of finished artifacts keyed by (video key, format ID), held under a total
+# byte budget with least-recently-used eviction. Files are published with an atomic rename,
+# so a reader only ever sees complete artifacts. File mtimes carry the LRU order across restarts.
+# Workers share the directory, so the index is rebuilt from disk on every publish and the
+# budget covers all processes, not each one.
+class ArtifactCache:
+    def __init__(self, root: str, budget_bytes: int):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # file name -> size, least recently used first
+        self._loaded = False
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest() + ".mp4"
+
+    # List the cached files on disk as (mtime, name, size), least recently used first
+    def _scan(self) -> list:
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                if not entry.is_file():
+                    continue
+                info = entry.stat()
+                if entry.name.endswith(".mp4"):
+                    found.append((info.st_mtime, entry.name, info.st_size))
+                elif entry.name.endswith(".tmp") and now - info.st_mtime > ARTIFACT_STALE_TMP_AGE:
+                    os.remove(entry.path)  # an interrupted publish; recent ones may be another process's
+            except FileNotFoundError:
+                pass  # evicted or published by another process meanwhile
+        return sorted(found)
+
+    def _index(self, found: list):
+        self._entries = OrderedDict((name, size) for _, name, size in found)
+        self.total_bytes = sum(self._entries.values())
+        self._loaded = True
+        self._evict()
+
+    # Index whatever a previous run (or another worker) left behind
+    def load(self):
+        self._index(self._scan())
+
+    # Path of a cached artifact, or None
+    def get(self, key: str) -> str:
+        if not self._loaded:
+            self.load()
+        name = self._name(key)
+        if name not in self._entries:
+            return None
+
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            self.total_bytes -= self._entries.pop(name)
+            return None
+        self._entries.move_to_end(name)
+        os.utime(path)
+        return path
+
+    @staticmethod
+    def _move_into_place(source_path: str, path: str):
+        try:
+            os.replace(source_path, path)
+        except OSError:
+            # Different filesystem (e.g. a tmpfs workspace): copy next to the target, then rename
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, path)
+        os.utime(path)  # newest in the LRU order, whatever the source's mtime was
+
+    # Move a finished file into the cache and return its new path, or None if it cannot fit.
+    # The file move runs in a thread; the index is only touched on the event loop.
+    async def publish(self, key: str, source_path: str) -> str:
+        if not self._loaded:
+            self.load()
+        size = os.path.getsize(source_path)
+        if size > self.budget_bytes:
+            return None
+
+        name = self._name(key)
+        path = os.path.join(self.root, name)
+        await asyncio.to_thread(self._move_into_place, source_path, path)
+        self._index(await asyncio.to_thread(self._scan))
+        return path
+
+    def _evict(self):
+        while self.total_bytes > self.budget_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+ARTIFACT_CACHE = ArtifactCache(ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_BYTES)
+
+# Coalesces identical concurrent work: the first caller for a key starts it, later callers
+# await the same task. The task is shielded, so one caller giving up never cancels it for the rest.
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+
+    # Returns (result, shared); shared is True when this caller joined work already in flight
+    async def do(self, key, work_factory) -> tuple:
+        task = self._inflight.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(work_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+# In-flight metadata extractions keyed by video, and downloads keyed by video + format
+METADATA_FLIGHTS = SingleFlight()
+DOWNLOAD_FLIGHTS = SingleFlight()
+
+# Progress of one download job, shown in its status message. Updated from yt-dlp hooks
+# (on download threads) and ffmpeg -progress; updating never talks to Telegram itself.
+class JobProgress:
+    def __init__(self, selected_quality: str):
+        self.selected_quality = selected_quality
+        self.stage = "starting"  # queued, starting, downloading, merging/converting, uploading
+        self.queue_position = None
+        self.downloads = {}  # label -> (downloaded_bytes, total_bytes, speed)
+        self.merged_seconds = None
+        self.duration = None
+
+    def queued(self, position: int):
+        self.stage, self.queue_position = "queued", position
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+
+    # yt-dlp progress hook status for one stream
+    def update_download(self, label: str, status: dict):
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        self.downloads[label] = (status.get('downloaded_bytes') or 0, total, status.get('speed'))
+        if self.stage in ("queued", "starting"):
+            self.stage = "downloading"
+
+    # run_ffmpeg on_progress callback
+    def update_merge(self, seconds: float, duration: float):
+        self.merged_seconds, self.duration = seconds, duration
+
+    @staticmethod
+    def _bar(fraction: float) -> str:
+        filled = round(max(0.0, min(fraction, 1.0)) * 10)
+        return "▓" * filled + "░" * (10 - filled) + f" {fraction:.0%}"
+
+    def render(self) -> str:
+        lines = [f"📺 Quality: *{self.selected_quality}*"]
+        if self.stage == "queued":
+            lines.append(f"⏳ Your download is queued (position *{self.queue_position}*). Please wait...")
+        elif self.stage == "starting":
+            lines.append("📥 Generating your download link, please wait...")
+        elif self.stage == "uploading":
+            lines.append("📤 Sending the file to you...")
+        else:
+            streams = list(self.downloads.values())
+            done = sum(downloaded for downloaded, _, _ in streams)
+            totals = [total for _, total, _ in streams]
+            speed = sum(speed or 0 for _, _, speed in streams)
+            if streams and all(totals):
+                line = f"📥 Downloading {self._bar(done / sum(totals))} ({done / 1024 / 1024:.1f}/{sum(totals) / 1024 / 1024:.1f} MB)"
+            else:
+                line = f"📥 Downloading ({done / 1024 / 1024:.1f} MB)"
+            if speed:
+                line += f" · {speed / 1024 / 1024:.1f} MB/s"
+            lines.append(line)
+            if self.merged_seconds is not None and self.duration:
+                action = "Converting" if self.stage == "converting" else "Merging"
+                lines.append(f"⚙️ {action} {self._bar(self.merged_seconds / self.duration)}")
+        return "\n".join(lines)
+
+# Applies JobProgress to status messages. Progress events only change the model; one loop per
+# chat edits at most one message per interval (round-robin over that chat's jobs), so the number
+# of API calls is bounded by time, never by how often yt-dlp or ffmpeg report.
+class ProgressEditor:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._chats = {}  # chat_id -> OrderedDict(message_id -> [progress, last_text])
+        self._tasks = {}  # chat_id -> editing loop
+
+    def track(self, bot, chat_id: int, message_id: int, progress: JobProgress):
+        self._chats.setdefault(chat_id, OrderedDict())[message_id] = [progress, None]
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._run(bot, chat_id))
+
+    def untrack(self, chat_id: int, message_id: int):
+        jobs = self._chats.get(chat_id)
+        if jobs is not None:
+            jobs.pop(message_id, None)
+
+    # The next job in this chat whose text changed since its last edit
+    def _next_edit(self, jobs: OrderedDict) -> tuple:
+        for _ in range(len(jobs)):
+            message_id, entry = next(iter(jobs.items()))
+            jobs.move_to_end(message_id)
+            text = entry[0].render()
+            if text != entry[1]:
+                return message_id, entry, text
+        return None, None, None
+
+    async def _run(self, bot, chat_id: int):
+        jobs = self._chats[chat_id]
+        try:
+            while jobs:
+                await asyncio.sleep(self.interval)
+                message_id, entry, text = self._next_edit(jobs)
+                if message_id is None:
+                    continue
+                entry[1] = text
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='Markdown')
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+                except TelegramError as e:
+                    logging.debug(f"Progress edit skipped: {e}")  # deleted meanwhile, or unchanged
+        finally:
+            self._chats.pop(chat_id, None)
+            self._tasks.pop(chat_id, None)
+
+PROGRESS_EDITOR = ProgressEditor(PROGRESS_EDIT_INTERVAL)
+
+# Extraction engine: long-lived yt-dlp instances, one per worker thread.
+# Extraction and downloads run on separate pools so a slow download never
+# holds up the metadata lookup for a new link.
+YDL_EXECUTOR = ThreadPoolExecutor(max_workers=EXTRACTOR_POOL_SIZE, thread_name_prefix="yt-dlp-extract")
+# A streamed merge needs its video and audio writers running at once (ffmpeg blocks opening
+# the second FIFO until it has a writer), so every job the scheduler admits gets two threads
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=max(DOWNLOAD_POOL_SIZE, 2 * MAX_CONCURRENT_DOWNLOADS), thread_name_prefix="yt-dlp-download")
+_ydl_local = threading.local()
+
+# Get the yt-dlp instance owned by the current worker thread
+def _get_ydl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_ydl_local, "ydl", None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(YDL_OPTIONS)
+        _ydl_local.ydl = ydl
+    return ydl
+
+# Pick a single format from an info dict: an exact format ID, "best" or "bestaudio"
+def select_format(info: dict, format_spec: str) -> dict:
+    formats = info.get('formats') or [info]
+    if format_spec == "bestaudio":
+        candidates = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+    elif format_spec == "best":
+        candidates = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none'] or formats
+    else:
+        candidates = [f for f in formats if f.get('format_id') == format_spec]
+
+    if not candidates:
+        raise yt_dlp.utils.DownloadError(f"Requested format is not available: {format_spec}")
+    # yt-dlp sorts formats from worst to best
+    return candidates[-1]
+
+def _extract_info_sync(url: str) -> dict:
+    return _get_ydl().extract_info(url, download=False)
+
+# Download one format to output_path (a file or a FIFO) and return the number of bytes written
+def _download_format_sync(info: dict, format_spec: str, output_path: str, cancel_event: threading.Event = None, workspace: JobWorkspace = None, on_progress=None) -> int:
+    ydl = _get_ydl()
+    selected = select_format(info, format_spec)
+
+    stream_info = {k: v for k, v in info.items() if k not in ('formats', 'requested_formats', 'requested_downloads')}
+    stream_info.update(selected)
+
+    params = ydl.params
+    to_pipe = os.path.exists(output_path) and stat.S_ISFIFO(os.stat(output_path).st_mode)
+    if to_pipe:
+        # A retry would reopen the pipe and replay bytes ffmpeg already consumed
+        params = {**params, 'retries': 0}
+
+    # Build the downloader ourselves so each download gets its own progress hooks
+    downloader = get_suitable_downloader(stream_info, params)(ydl, params)
+    progress = {"bytes": 0}
+
+    def track_progress(status):
+        if cancel_event is not None and cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+        progress["bytes"] = status.get('downloaded_bytes') or progress["bytes"]
+        # Bytes sent into a pipe never land in the workspace
+        if workspace is not None and not to_pipe:
+            workspace.charge(output_path, progress["bytes"])
+        if on_progress is not None:
+            on_progress(status)
+    downloader.add_progress_hook(track_progress)
+
+    # download() returns (success, real_download ran); the tuple itself is always truthy
+    success, _ = downloader.download(output_path, stream_info)
+    if not success:
+        raise yt_dlp.utils.DownloadError(f"Failed to download format {format_spec}")
+    return progress["bytes"]
+
+# Extract the info dict for a link without blocking the event loop
+async def extract_info(url: str) -> dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(YDL_EXECUTOR, _extract_info_sync, url)
+
+# Download a single format of an already extracted video to output_path without blocking the event loop.
+# Cancelling the caller stops the transfer at the next progress tick. on_progress receives each
+# yt-dlp progress status, on the download thread.
+async def download_format(info: dict, format_spec: str, output_path: str, workspace: JobWorkspace = None, on_progress=None) -> int:
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    future = loop.run_in_executor(DOWNLOAD_EXECUTOR, _download_format_sync, info, format_spec, output_path, cancel_event, workspace, on_progress)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        # Wait for the thread to let go of the file before the caller cleans up
+        await asyncio.wait([future])
+        if not future.cancelled():
+            future.exception()  # the expected DownloadCancelled; mark it retrieved
+        raise
+
+# Download one format and log its size, duration and throughput; returns seconds taken
+async def timed_download(info: dict, label: str, format_spec: str, output_path: str, workspace: JobWorkspace = None, progress: JobProgress = None) -> float:
+    started = time.monotonic()
+    on_progress = (lambda status: progress.update_download(label, status)) if progress else None
+    downloaded_bytes = await download_format(info, format_spec, output_path, workspace, on_progress)
+    elapsed = time.monotonic() - started
+    size_mb = downloaded_bytes / 1024 / 1024
+    logging.info(f"Downloaded {label} stream ({format_spec}): {size_mb:.1f} MB in {elapsed:.1f}s ({size_mb / max(elapsed, 0.001):.1f} MB/s)")
+    return elapsed
+
+# Download several formats at once; the first failure cancels the rest.
+# streams is a list of (label, format_spec, output_path).
+async def download_streams(info: dict, streams: list, workspace: JobWorkspace = None, progress: JobProgress = None):
+    started = time.monotonic()
+    tasks = [asyncio.create_task(timed_download(info, *stream, workspace=workspace, progress=progress)) for stream in streams]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in done:
+        if task.exception():
+            raise task.exception()
+
+    total = time.monotonic() - started
+    sequential = sum(task.result() for task in tasks)
+    logging.info(f"Downloaded {len(streams)} streams in {total:.1f}s (sequential would take ~{sequential:.1f}s)")
+
+# Whether every selected format can be read by ffmpeg from a pipe: plain HTTP(S) and a
+# streamable container (progressive MP4 may keep its index at the end of the file)
+def can_stream_merge(info: dict, format_specs: list) -> bool:
+    for format_spec in format_specs:
+        try:
+            selected = select_format(info, format_spec)
+        except yt_dlp.utils.DownloadError:
+            return False
+        if selected.get('protocol') not in ('http', 'https'):
+            return False
+        if selected.get('ext') in ('mp4', 'm4a') and not (selected.get('container') or '').endswith('_dash'):
+            return False
+    return True
+
+# Open and immediately close a read end of a FIFO. Closing our last reader makes a
+# writer's next write fail with EPIPE; opening one releases a writer stuck in open().
+def _poke_fifo(fifo_path: str, reader_fd: int = None):
+    try:
+        if reader_fd is None:
+            reader_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        os.close(reader_fd)
+    except OSError:
+        pass
+
+# Download the given formats into FIFOs that ffmpeg reads directly, so only ffmpeg's
+# output is written to disk. streams is a list of (label, format_spec); ffmpeg_args
+# are the options and output placed after one -i per stream. Returns (returncode, stderr).
+async def stream_merge(info: dict, streams: list, ffmpeg_args: list, workspace: JobWorkspace, progress: JobProgress = None) -> tuple:
+    # Take the merge slot before any download starts: a writer with no ffmpeg reading its
+    # pipe stalls its HTTP connection, and pipe downloads are never retried
+    async with MERGE_SEMAPHORE:
+        return await _stream_merge(info, streams, ffmpeg_args, workspace, progress)
+
+async def _stream_merge(info: dict, streams: list, ffmpeg_args: list, workspace: JobWorkspace, progress: JobProgress = None) -> tuple:
+    fifo_dir = tempfile.mkdtemp(prefix="pipe-", dir=workspace.path)
+    fifo_paths = []
+    reader_fds = []
+    for label, _ in streams:
+        fifo_path = os.path.join(fifo_dir, label)
+        os.mkfifo(fifo_path)
+        fifo_paths.append(fifo_path)
+        # Hold a read end ourselves so a writer's open() never blocks on a missing reader
+        reader_fds.append(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+
+    started = time.monotonic()
+    input_args = [arg for fifo_path in fifo_paths for arg in ("-i", fifo_path)]
+    on_merge_progress = progress.update_merge if progress else None
+    ffmpeg_task = asyncio.create_task(_run_ffmpeg_process(input_args + ffmpeg_args, duration=info.get('duration'), on_progress=on_merge_progress))
+    download_tasks = [
+        asyncio.create_task(timed_download(info, label, format_spec, fifo_path, progress=progress))
+        for (label, format_spec), fifo_path in zip(streams, fifo_paths)
+    ]
+
+    try:
+        pending = {ffmpeg_task, *download_tasks}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Stop once ffmpeg exits, whatever its code: it may stop early with 0 (the -fs limit),
+            # and writers left on full pipes only get EPIPE when the cleanup below drops our readers
+            if ffmpeg_task in done or any(task.exception() for task in done):
+                break
+
+        for task in download_tasks:
+            if task.done() and task.exception():
+                raise task.exception()
+        if not ffmpeg_task.done() or ffmpeg_task.exception():
+            raise ffmpeg_task.exception() or yt_dlp.utils.DownloadError("ffmpeg did not finish")
+        returncode, stderr = ffmpeg_task.result()
+        if returncode == 0:
+            logging.info(f"Streamed and merged {len(streams)} streams in {time.monotonic() - started:.1f}s")
+        return returncode, stderr
+    finally:
+        # Stop ffmpeg first, then drop our readers so any writer blocked in write() gets EPIPE
+        ffmpeg_task.cancel()
+        await asyncio.gather(ffmpeg_task, return_exceptions=True)
+        for fifo_path, fd in zip(fifo_paths, reader_fds):
+            _poke_fifo(fifo_path, fd)
+        for task in download_tasks:
+            task.cancel()
+        # A writer may still be opening its FIFO; keep offering a reader until it gives up
+        while not all(task.done() for task in download_tasks):
+            for fifo_path in fifo_paths:
+                _poke_fifo(fifo_path)
+            await asyncio.wait(download_tasks, timeout=0.1)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+# Function to fetch the info dict for a link; this is the only extraction a link needs
+async def fetch_video_info(url: str) -> dict:
+    cache_key = video_cache_key(url)
+    video_info = METADATA_CACHE.get(cache_key)
+    if video_info is not None:
+        return video_info
+
+    # Everyone asking for this video right now shares one extraction
+    video_info, _ = await METADATA_FLIGHTS.do(cache_key, lambda: _load_video_info(url, cache_key))
+    return video_info
+
+# Top-level info fields the bot uses. The rest (thumbnails, automatic captions, subtitles...)
+# can add up to megabytes per video and is dropped before caching. The stream fields keep
+# single-format results (no `formats` list) downloadable.
+VIDEO_INFO_FIELDS = (
+    'id', 'title', 'description', 'duration', 'uploader', 'webpage_url', 'extractor', 'extractor_key',
+    'url', 'ext', 'protocol', 'format_id', 'vcodec', 'acodec', 'http_headers',
+)
+
+def trim_video_info(info: dict) -> dict:
+    trimmed = {key: info[key] for key in VIDEO_INFO_FIELDS if key in info}
+    if info.get('formats'):
+        # Storyboards are image formats with long fragment lists and are never downloaded
+        trimmed['formats'] = [
+            f for f in info['formats']
+            if f.get('vcodec') != 'none' or f.get('acodec') != 'none'
+        ]
+    return trimmed
+
+async def _load_video_info(url: str, cache_key: str) -> dict:
+    try:
+        video_info = trim_video_info(await extract_info(url))
+    except yt_dlp.utils.DownloadError as e:
+        logging.error(f"yt-dlp error: {e}")
+        return None
+    except Exception as e:
+        logging.error(f"Error fetching video info: {e}")
+        return None
+
+    # Never keep an entry past the point where its stream URLs expire
+    ttl = METADATA_CACHE.ttl
+    lifetime = signed_url_lifetime(video_info)
+    if lifetime is not None:
+        ttl = min(ttl, lifetime - SIGNED_URL_SAFETY_MARGIN)
+    if ttl > 0:
+        METADATA_CACHE.set(cache_key, video_info, ttl)
+    return video_info
+
 # Function to generate and send the direct download link for Instagram
 async def send_instagram_download_link(chat_id: int, link: str, context):
     try:
-        command = ["yt-dlp", "-g", "-f", "best", link]
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        if result.returncode != 0:
+        video_info = await fetch_video_info(link)
+        if not video_info:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-            logging.error(f"yt-dlp error: {result.stderr.strip()}")
             return
 
-        direct_link = result.stdout.strip()
-        if direct_link:
-            short_link = shorten_url(direct_link)
-
-            # Fetch video info to get the title and caption
-            video_info_command = ["yt-dlp", "-j", "--cookies", "cookies.txt", link]
-            process = await asyncio.create_subprocess_exec(
-                *video_info_command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            video_info_stdout, video_info_stderr = await process.communicate()
+        direct_link = select_format(video_info, "best").get('url')
 
-            if process.returncode != 0:
-                logging.error(f"Error fetching video info: {video_info_stderr.decode().strip()}")
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-                return
+        if direct_link:
+            short_link = await shorten_url(direct_link)
 
-            video_info = json.loads(video_info_stdout.decode().strip())
             video_title = video_info['title']
-            video_caption = video_info.get('description', 'No caption available')
+            video_caption = video_info.get('description') or 'No caption available'
 
             # Remove hashtags and associated words from the caption
             clean_caption = re.sub(r'#\w+', '', video_caption)
@@ -216,92 +1470,554 @@ async def send_instagram_download_link(chat_id: int, link: str, context):
         await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an unexpected error occurred.")
         logging.error(f"Unexpected error: {e}")
 
-# Function to fetch available formats for YouTube
-async def fetch_formats(url: str) -> list:
+# What a job returns when it sent links instead of a file, so joined requests can do the same
+LinkDelivery = namedtuple("LinkDelivery", "format_id size")
+
+# Link delivery for videos too large to upload: send the signed stream URLs (video, plus
+# audio when the format has none) instead of downloading and merging them
+async def send_stream_links(chat_id: int, link: str, context, format_id: str, selected_quality: str, video_info: dict, size: int = None):
     try:
-        command = ["yt-dlp", "-F", "--cookies", "cookies.txt", url]
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        video = select_format(video_info, format_id)
+        if video.get('vcodec') == 'none':
+            streams = [("🔊 Download audio", video)]
+        else:
+            streams = [("🎬 Download video", video)]
+        if video.get('acodec') == 'none':
+            streams.append(("🔊 Download audio", select_format(video_info, "bestaudio")))
+        short_links = await asyncio.gather(*(shorten_url(f['url']) for _, f in streams))
+    except Exception as e:
+        logging.error(f"Error preparing stream links: {e}")
+        await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+        return
+
+    size_note = f"about *{size / (1024 * 1024):.0f} MB*" if size else "too large"
+    message = (
+        f"🎥 *{video_info.get('title', 'Video')}*\n"
+        f"📺 Quality: *{selected_quality}*\n"
+        f"📦 This video is {size_note}, over Telegram's upload limit, so here are direct links:\n\n"
+        + "\n".join(f"[{label}]({short_link})" for (label, _), short_link in zip(streams, short_links))
+    )
+    await context.bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
+    add_to_history(chat_id, link, format_id)
+
+# One downloadable format, built from an entry of the info dict's `formats` list
+class VideoFormat(NamedTuple):
+    format_id: str
+    ext: str
+    height: int
+    fps: float
+    vcodec: str
+    acodec: str
+    tbr: float  # total bitrate, KBit/s
+    abr: float  # audio bitrate, KBit/s
+    filesize: int  # exact or approximate size in bytes, None if unknown
+    protocol: str
+    format_note: str
+
+    @classmethod
+    def from_info(cls, f: dict) -> "VideoFormat":
+        return cls(
+            format_id=str(f['format_id']),
+            ext=f.get('ext') or '',
+            height=f.get('height'),
+            fps=f.get('fps'),
+            vcodec=f.get('vcodec') or 'none',
+            acodec=f.get('acodec') or 'none',
+            tbr=f.get('tbr'),
+            abr=f.get('abr'),
+            filesize=f.get('filesize') or f.get('filesize_approx'),
+            protocol=f.get('protocol') or '',
+            format_note=f.get('format_note') or '',
         )
-        stdout, stderr = await process.communicate()
 
-        if process.returncode != 0:
-            logging.error(f"yt-dlp error: {stderr.decode().strip()}")
-            return None
+    @property
+    def has_video(self) -> bool:
+        return self.vcodec != 'none'
+
+    @property
+    def has_audio(self) -> bool:
+        return self.acodec != 'none'
+
+    # Quality tier label ("720p"), from the note YouTube gives ("720p60") or else the height
+    @property
+    def tier(self) -> str:
+        match = FORMAT_NOTE_HEIGHT_REGEX.match(self.format_note)
+        height = int(match.group(1)) if match else self.height
+        return f"{height}p" if height else None
+
+# Quality tiers offered on the keyboard, lowest first
+QUALITY_TIERS = ['144p', '240p', '360p', '480p', '720p', '1080p']
+FORMAT_NOTE_HEIGHT_REGEX = re.compile(r'(\d{3,4})p')
+
+# Ranking within a video tier: mp4/H.264 (copies into the merged mp4 as-is), direct
+# HTTP over HLS/DASH fragments, video-only over muxed (the audio comes from bestaudio),
+# then frame rate and bitrate
+def video_rank(fmt: VideoFormat) -> tuple:
+    return (
+        fmt.ext == 'mp4',
+        fmt.vcodec.startswith(('avc1', 'h264')),
+        fmt.protocol in ('https', 'http'),
+        not fmt.has_audio,
+        fmt.fps or 0,
+        fmt.tbr or 0,
+    )
 
-        formats = []
-        for line in stdout.decode().splitlines():
-            if re.match(r"^\d+", line):  # Format lines start with a number
-                parts = line.split()
-                format_id = parts[0]
-                resolution = " ".join(parts[1:])  # Combine remaining parts for resolution/quality
-                formats.append((format_id, resolution))
-        return formats
-    except Exception as e:
-        logging.error(f"Error fetching formats: {e}")
+# Ranking among audio-only formats: skip dynamic-range-compressed tracks, then bitrate
+def audio_rank(fmt: VideoFormat) -> tuple:
+    is_drc = 'DRC' in fmt.format_note or fmt.format_id.endswith('-drc')
+    return (not is_drc, fmt.protocol in ('https', 'http'), fmt.abr or fmt.tbr or 0)
+
+# Predicted size of one stream in bytes: the reported (or approximate) size, else bitrate x duration
+def estimated_stream_size(fmt: VideoFormat, duration: float) -> int:
+    if fmt.filesize:
+        return fmt.filesize
+    if fmt.tbr and duration:
+        return int(fmt.tbr * 1000 / 8 * duration)
+    return None
+
+# Predicted size of the merged video+audio file, or None if the metadata doesn't tell
+def estimate_merged_size(video: VideoFormat, audio: VideoFormat, duration: float) -> int:
+    sizes = [estimated_stream_size(video, duration)]
+    if not video.has_audio and audio is not None:
+        sizes.append(estimated_stream_size(audio, duration))
+    if None in sizes:
         return None
+    return int(sum(sizes) * MERGE_OVERHEAD)
 
-# Function to generate and send the direct download link for YouTube
-async def send_youtube_download_link(format_id: str, chat_id: int, link: str, context, selected_quality: str):
+# Same prediction for a job, from the streams its merge plan (or the audio pipeline) will download
+def predict_merged_size(video_info: dict, format_id: str) -> int:
+    try:
+        if is_audio_job(format_id):
+            return estimated_stream_size(pick_audio_source(video_info, format_id[len(AUDIO_JOB_PREFIX):]), video_info.get('duration'))
+        plan = plan_merge(video_info, format_id)
+    except yt_dlp.utils.DownloadError:
+        return None
+    video, audio = plan.streams[0][1], plan.streams[-1][1] if len(plan.streams) > 1 else None
+    return estimate_merged_size(video, audio, video_info.get('duration'))
+
+def fits_upload_limit(size: int) -> bool:
+    # Unknown sizes are attempted; the merged file is checked again before upload
+    return size is None or size <= TELEGRAM_UPLOAD_LIMIT_BYTES
+
+# Function to list available formats for YouTube from the video info
+def fetch_formats(video_info: dict) -> list:
+    return [VideoFormat.from_info(f) for f in video_info.get('formats') or [] if f.get('format_id')]
+
+# Best format per quality tier plus 'best_audio', in one pass over the formats.
+# Returns {quality: VideoFormat} ordered like the keyboard (QUALITY_TIERS, then audio).
+def best_formats_by_tier(formats: list) -> dict:
+    best = {}
+    for fmt in formats:
+        if fmt.has_video:
+            quality, rank = fmt.tier, video_rank
+            if quality not in QUALITY_TIERS:
+                continue
+        elif fmt.has_audio:
+            quality, rank = 'best_audio', audio_rank
+        else:
+            continue  # storyboards and other imageless/soundless entries
+        current = best.get(quality)
+        if current is None or rank(fmt) > rank(current):
+            best[quality] = fmt
+    return {quality: best[quality] for quality in QUALITY_TIERS + ['best_audio'] if quality in best}
+
+# Audio codecs that go into the merged mp4 as-is; anything else is re-encoded to AAC
+MP4_COPY_AUDIO_CODECS = ('mp4a', 'aac')
+
+def can_copy_audio(codec: str) -> bool:
+    return (codec or '').lower().startswith(MP4_COPY_AUDIO_CODECS)
+
+# How a job turns its downloads into the merged mp4. streams is a list of (label, VideoFormat),
+# one ffmpeg input each; video is always stream-copied, audio too when copy_audio is set.
+class MergePlan(NamedTuple):
+    streams: list
+    map_args: list
+    copy_audio: bool
+
+    def output_args(self, output_path: str, size_limit: int) -> list:
+        audio_args = ["-c:a", "copy"] if self.copy_audio else ["-c:a", "aac"]
+        return self.map_args + ["-c:v", "copy"] + audio_args + ["-fs", str(size_limit), output_path]
+
+# Choose the inputs for a job from the metadata: the selected format plus the best audio
+# track that can be copied into mp4 (AAC), falling back to the best audio overall, re-encoded
+def plan_merge(video_info: dict, format_id: str) -> MergePlan:
+    formats = fetch_formats(video_info)
+    selected = next((fmt for fmt in formats if fmt.format_id == format_id), None)
+    if selected is None:
+        raise yt_dlp.utils.DownloadError(f"Requested format is not available: {format_id}")
+
+    if not selected.has_video:
+        return MergePlan([("audio", selected)], ["-map", "0:a:0"], can_copy_audio(selected.acodec))
+
+    audio_formats = [fmt for fmt in formats if fmt.has_audio and not fmt.has_video]
+    if not audio_formats:
+        if not selected.has_audio:
+            raise yt_dlp.utils.DownloadError("No audio stream available")
+        # Muxed format and nothing better to pair it with: remux it on its own
+        return MergePlan([("video", selected)], ["-map", "0:v:0", "-map", "0:a:0"], can_copy_audio(selected.acodec))
+
+    audio = max(audio_formats, key=lambda fmt: (can_copy_audio(fmt.acodec), audio_rank(fmt)))
+    return MergePlan([("video", selected), ("audio", audio)], ["-map", "0:v:0", "-map", "1:a:0"], can_copy_audio(audio.acodec))
+
+# Audio outputs a user can pick with /setdefault. A source track already in the right codec is
+# sent as downloaded, or remuxed if only the container differs; anything else is encoded.
+AUDIO_OUTPUTS = {
+    "m4a": {"codecs": ("mp4a", "aac"), "ext": "m4a", "mime": "audio/mp4", "encode": ["-c:a", "aac", "-b:a", "192k"]},
+    "opus": {"codecs": ("opus",), "ext": "ogg", "mime": "audio/ogg", "encode": ["-c:a", "libopus", "-b:a", "160k"]},
+    "mp3": {"codecs": ("mp3",), "ext": "mp3", "mime": "audio/mpeg", "encode": ["-c:a", "libmp3lame", "-q:a", "2"]},
+}
+AUDIO_SOURCE_MIME = {"m4a": "audio/mp4", "webm": "audio/webm", "mp3": "audio/mpeg", "ogg": "audio/ogg"}
+
+# Audio jobs are keyed by their output rather than the source format, e.g. "audio:m4a"
+AUDIO_JOB_PREFIX = "audio:"
+
+def audio_job_id(audio_format: str) -> str:
+    return f"{AUDIO_JOB_PREFIX}{audio_format or 'original'}"
+
+def is_audio_job(format_id: str) -> bool:
+    return format_id.startswith(AUDIO_JOB_PREFIX)
+
+# The audio-only format to download for an output: one already in the target codec if the
+# video has it, otherwise the best track overall. With no output chosen the track is sent as
+# it is, so prefer AAC (like plan_merge does), which Telegram plays instead of filing as a document.
+def pick_audio_source(video_info: dict, audio_format: str) -> VideoFormat:
+    codecs = AUDIO_OUTPUTS[audio_format]["codecs"] if audio_format in AUDIO_OUTPUTS else MP4_COPY_AUDIO_CODECS
+    candidates = [fmt for fmt in fetch_formats(video_info) if fmt.has_audio and not fmt.has_video]
+    if not candidates:
+        raise yt_dlp.utils.DownloadError("No audio-only format available")
+    return max(candidates, key=lambda fmt: (fmt.acodec.lower().startswith(codecs), audio_rank(fmt)))
+
+# Merge stage: ffmpeg runs as an async subprocess, bounded to MERGE_CONCURRENCY at a time
+MERGE_SEMAPHORE = asyncio.Semaphore(MERGE_CONCURRENCY)
+
+# Parse one key=value block of ffmpeg's -progress output into seconds of output written
+def _ffmpeg_progress_seconds(key: str, value: str) -> float:
+    if key in ("out_time_us", "out_time_ms"):  # both are microseconds despite the name
+        try:
+            return int(value) / 1_000_000
+        except ValueError:
+            return None
+    return None
+
+# Codec of the first audio stream in a file, or None if ffprobe can't tell
+async def probe_audio_codec(path: str) -> str:
     try:
-        # Create the downloads directory if it doesn't exist
-        downloads_dir = "downloads"
-        if not os.path.exists(downloads_dir):
-            os.makedirs(downloads_dir)
-
-        # Download the video
-        video_path = os.path.join(downloads_dir, f"video.{format_id}.mp4")
-        video_command = ["yt-dlp", "--cookies", "cookies.txt", "-f", format_id, "-o", video_path, link]
-        video_process = await asyncio.create_subprocess_exec(
-            *video_command,
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name", "-of", "csv=p=0", path,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.DEVNULL
         )
-        await video_process.communicate()
+        stdout, _ = await process.communicate()
+    except OSError:
+        return None
+    return stdout.decode(errors="replace").strip() or None
+
+# Run ffmpeg without blocking the event loop. Returns (returncode, stderr).
+# on_progress(seconds_done, duration) is called as ffmpeg reports progress; setting
+# cancel_event, or cancelling the caller, kills the process and raises CancelledError.
+async def run_ffmpeg(args: list, duration: float = None, cancel_event: asyncio.Event = None, on_progress=None) -> tuple:
+    async with MERGE_SEMAPHORE:
+        return await _run_ffmpeg_process(args, duration, cancel_event, on_progress)
+
+# run_ffmpeg for callers already holding a MERGE_SEMAPHORE slot
+async def _run_ffmpeg_process(args: list, duration: float = None, cancel_event: asyncio.Event = None, on_progress=None) -> tuple:
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostats", "-y", "-progress", "pipe:1", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
 
-        # Download the audio
-        audio_path = os.path.join(downloads_dir, f"audio.{format_id}.webm")
-        audio_command = ["yt-dlp", "--cookies", "cookies.txt", "-f", "bestaudio", "-o", audio_path, link]
-        audio_process = await asyncio.create_subprocess_exec(
-            *audio_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+    async def read_progress():
+        async for raw_line in process.stdout:
+            key, _, value = raw_line.decode(errors="replace").strip().partition("=")
+            seconds = _ffmpeg_progress_seconds(key, value)
+            if seconds is not None and on_progress:
+                on_progress(seconds, duration)
+
+    async def read_stderr() -> str:
+        return (await process.stderr.read()).decode(errors="replace")
+
+    work = asyncio.gather(read_progress(), read_stderr(), process.wait())
+    waiters = [work]
+    if cancel_event is not None:
+        waiters.append(asyncio.ensure_future(cancel_event.wait()))
+
+    try:
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            raise asyncio.CancelledError()
+        _, stderr, returncode = work.result()
+        return returncode, stderr
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+# A queued download: lower cost runs first
+class _DownloadJob:
+    def __init__(self, user_id: int, cost: float, seq: int, factory, on_position):
+        self.user_id = user_id
+        self.cost = cost
+        self.seq = seq
+        self.factory = factory
+        self.on_position = on_position
+        self.queued_at = time.monotonic()
+        self.position = None
+        self.future = None
+        self.task = None
+
+# Bounded pool of download jobs with a per-user in-flight cap and a priority queue.
+# Jobs are ordered by estimated cost minus an aging credit, so short clips and audio
+# jump ahead of long high-resolution downloads without starving them.
+class DownloadScheduler:
+    def __init__(self, max_workers: int, max_per_user: int, aging_rate: float = SCHEDULER_AGING_RATE):
+        self.max_workers = max_workers
+        self.max_per_user = max_per_user
+        self.aging_rate = aging_rate
+        self._pending = []
+        self._running = {}  # user_id -> jobs in flight
+        self._active = 0
+        self._seq = itertools.count()
+        self._tasks = set()
+
+    # Run job_factory() once a worker slot is free; on_position(n) is awaited as the queue moves
+    async def run(self, user_id: int, cost: float, job_factory, on_position=None):
+        job = _DownloadJob(user_id, cost, next(self._seq), job_factory, on_position)
+        job.future = asyncio.get_running_loop().create_future()
+        self._pending.append(job)
+        self._dispatch()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if job in self._pending:
+                self._pending.remove(job)
+                self._report_positions()
+            elif job.task:
+                job.task.cancel()
+            raise
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def _order(self) -> list:
+        now = time.monotonic()
+        return sorted(self._pending, key=lambda job: (job.cost - (now - job.queued_at) * self.aging_rate, job.seq))
+
+    def _dispatch(self):
+        for job in self._order():
+            if self._active >= self.max_workers:
+                break
+            if self._running.get(job.user_id, 0) >= self.max_per_user:
+                continue
+
+            self._pending.remove(job)
+            self._active += 1
+            self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+            job.task = self._spawn(self._run(job))
+        self._report_positions()
+
+    def _report_positions(self):
+        for position, job in enumerate(self._order(), start=1):
+            if job.on_position and job.position != position:
+                job.position = position
+                self._spawn(job.on_position(position))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, job: _DownloadJob):
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._active -= 1
+            self._running[job.user_id] -= 1
+            if not self._running[job.user_id]:
+                del self._running[job.user_id]
+            self._dispatch()
+
+DOWNLOAD_SCHEDULER = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_USER)
+
+# Estimate the work a download takes: duration scaled by resolution, audio is cheap
+def job_cost(video_info: dict, selected_quality: str) -> float:
+    duration = (video_info or {}).get('duration') or 600
+    if selected_quality == 'best_audio':
+        return duration * 0.1
+    height = int(selected_quality[:-1]) if selected_quality[:-1].isdigit() else 720
+    return duration * height / 360
+
+# Queue a YouTube download and keep the status message updated with the user's queue position
+async def schedule_youtube_download(format_id: str, chat_id: int, link: str, context, selected_quality: str, status_message_id: int, video_info: dict = None):
+    # Already delivered once: re-send by file_id without queueing anything
+    if await send_cached_video(chat_id, link, format_id, context, selected_quality):
+        return
+    # Merged before: upload the cached file without extracting, predicting or queueing
+    if await send_cached_artifact(chat_id, link, format_id, context, selected_quality):
+        return
+
+    if video_info is None:
+        video_info = await fetch_video_info(link)
+
+    # Predicted to exceed the upload limit: don't spend bandwidth and CPU on a file we can't send
+    predicted_size = predict_merged_size(video_info, format_id) if video_info else None
+    if not fits_upload_limit(predicted_size):
+        link_format_id = format_id
+        if is_audio_job(format_id):
+            # Audio job IDs name an output, not a format; link the track the pipeline would download
+            link_format_id = pick_audio_source(video_info, format_id[len(AUDIO_JOB_PREFIX):]).format_id
+        await send_stream_links(chat_id, link, context, link_format_id, selected_quality, video_info, predicted_size)
+        return
+
+    # Queue position, download and merge progress all go through the coalescing editor
+    progress = JobProgress(selected_quality)
+
+    async def report_position(position: int):
+        if progress.stage in ("queued", "starting"):
+            progress.queued(position)
+
+    async def run_job():
+        progress.set_stage("starting")
+        return await send_youtube_download_link(format_id, chat_id, link, context, selected_quality, video_info, progress)
+
+    # The first request for this video and format runs the job and delivers to its own chat;
+    # identical requests arriving meanwhile wait for it and then reuse the upload or the artifact
+    flight_key = file_id_key(link, format_id)
+    if flight_key in DOWNLOAD_FLIGHTS:
+        try:
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=status_message_id, text="⏳ This video is already being prepared, it will be sent to you shortly...")
+        except Exception as e:
+            logging.warning(f"Failed to update status message: {e}")
+
+    # Only the request that runs the job shows its progress; a joined request keeps the note
+    # above. Checked again because the job may have finished while that edit was sent.
+    joined = flight_key in DOWNLOAD_FLIGHTS
+    if not joined:
+        PROGRESS_EDITOR.track(context.bot, chat_id, status_message_id, progress)
+    try:
+        outcome, shared = await DOWNLOAD_FLIGHTS.do(
+            flight_key,
+            lambda: DOWNLOAD_SCHEDULER.run(chat_id, job_cost(video_info, selected_quality), run_job, on_position=report_position)
         )
-        await audio_process.communicate()
+    finally:
+        if not joined:
+            PROGRESS_EDITOR.untrack(chat_id, status_message_id)
+    if not shared:
+        return
 
-        if video_process.returncode != 0 or audio_process.returncode != 0:
-            logging.error(f"Error fetching download link.")
-            await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
-            return
+    # The job turned out too large to upload and sent links; send them here too
+    if isinstance(outcome, LinkDelivery):
+        await send_stream_links(chat_id, link, context, outcome.format_id, selected_quality, video_info, outcome.size)
+        return
 
-        # Merge video and audio using ffmpeg
-        merged_path = os.path.join(downloads_dir, f"{format_id}_merged.mp4")
-        ffmpeg_command = [
-            "ffmpeg", "-i", video_path, "-i", audio_path,
-            "-c:v", "copy", "-c:a", "aac", "-strict", "experimental", merged_path
-        ]
-        ffmpeg_process = subprocess.run(ffmpeg_command, capture_output=True)
+    if await send_cached_video(chat_id, link, format_id, context, selected_quality):
+        return
+    if await send_cached_artifact(chat_id, link, format_id, context, selected_quality):
+        return
+    await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
 
-        if ffmpeg_process.returncode != 0:
-            logging.error(f"Error merging video and audio: {ffmpeg_process.stderr.decode().strip()}")
-            await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+# Function to generate and send the direct download link for YouTube
+async def send_youtube_download_link(format_id: str, chat_id: int, link: str, context, selected_quality: str, video_info: dict = None, progress: JobProgress = None):
+    try:
+        # An identical job may have finished while this one was queued
+        if await send_cached_video(chat_id, link, format_id, context, selected_quality):
             return
 
-        # Send the merged video to the user
-        with open(merged_path, 'rb') as video_file:
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=video_file,
-                caption=f"🎥 *Merged Video*\n📺 Quality: *{selected_quality}*\n\n",
-                parse_mode='Markdown'
-            )
+        # Merged before for another chat: skip yt-dlp and ffmpeg and go straight to delivery
+        if await send_cached_artifact(chat_id, link, format_id, context, selected_quality):
+            return
+        artifact_key = file_id_key(link, format_id)
+
+        # Reuse the info extracted when the link came in; only extract if we don't have it
+        if video_info is None:
+            video_info = await fetch_video_info(link)
+            if not video_info:
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+                return
 
-        # Clean up temporary files
-        os.remove(video_path)
-        os.remove(audio_path)
-        os.remove(merged_path)
+        # Audio-only: one download and no merge
+        if is_audio_job(format_id):
+            return await send_youtube_audio(format_id, chat_id, link, context, video_info, progress)
+
+        # Every job works in its own directory, removed however the job ends
+        with JobWorkspace() as workspace:
+            merged_path = workspace.file("merged.mp4")
+
+            try:
+                # Pair the video with audio that can be copied, so ffmpeg only remuxes
+                plan = plan_merge(video_info, format_id)
+                streams = [(label, fmt.format_id) for label, fmt in plan.streams]
+                input_paths = [workspace.file(f"{label}.{fmt.ext or 'bin'}") for label, fmt in plan.streams]
+
+                streamed = MERGE_PIPELINE == "stream" and can_stream_merge(video_info, [format_spec for _, format_spec in streams])
+                if not streamed:
+                    # Download the video and audio at the same time, then merge them below
+                    await download_streams(video_info, [
+                        (label, format_spec, path) for (label, format_spec), path in zip(streams, input_paths)
+                    ], workspace, progress)
+                    # The metadata may not name the audio codec; the downloaded file does
+                    if not plan.copy_audio and can_copy_audio(await probe_audio_codec(input_paths[-1])):
+                        plan = plan._replace(copy_audio=True)
+
+                output_limit = workspace.remaining()
+                output_args = plan.output_args(merged_path, output_limit)
+                if streamed:
+                    # Pipe both downloads straight into ffmpeg; only the merged file is written
+                    returncode, ffmpeg_stderr = await stream_merge(video_info, streams, output_args, workspace, progress)
+                else:
+                    if progress:
+                        progress.set_stage("merging")
+                    returncode, ffmpeg_stderr = await run_ffmpeg(
+                        [arg for path in input_paths for arg in ("-i", path)] + output_args,
+                        duration=video_info.get('duration'),
+                        on_progress=progress.update_merge if progress else None
+                    )
+
+                # ffmpeg stops writing at -fs; hitting the limit means the output was cut short
+                if returncode == 0:
+                    workspace.charge(merged_path, os.path.getsize(merged_path))
+                    if os.path.getsize(merged_path) >= output_limit:
+                        raise WorkspaceQuotaExceeded("Merged output reached the workspace quota")
+            except WorkspaceQuotaExceeded as e:
+                logging.error(f"Workspace quota exceeded: {e}")
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, this video is too large to process.")
+                return
+            except yt_dlp.utils.DownloadError as e:
+                logging.error(f"Error fetching download link: {e}")
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+                return
+
+            if returncode != 0:
+                logging.error(f"Error merging video and audio: {ffmpeg_stderr.strip()}")
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+                return
+
+            # The metadata had no size (or underestimated it) and the result is too big to upload
+            merged_size = os.path.getsize(merged_path)
+            if not fits_upload_limit(merged_size):
+                await send_stream_links(chat_id, link, context, format_id, selected_quality, video_info, merged_size)
+                return LinkDelivery(format_id, merged_size)
+
+            # Keep the result for other chats, then send it to the user
+            if progress:
+                progress.set_stage("uploading")
+            published_path = await ARTIFACT_CACHE.publish(artifact_key, merged_path)
+            await deliver_video_file(chat_id, link, format_id, published_path or merged_path, context, selected_quality)
 
         add_to_history(chat_id, link, format_id)
     except Exception as e:
@@ -309,24 +2025,159 @@ async def send_youtube_download_link(format_id: str, chat_id: int, link: str, co
         await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an unexpected error occurred.")
 
 
+# Audio-only jobs: download the one track, convert only if the requested output needs it,
+# and send it with send_audio. Conversions are ffmpeg processes bounded like merges.
+async def send_youtube_audio(job_id: str, chat_id: int, link: str, context, video_info: dict, progress: JobProgress = None):
+    audio_format = job_id[len(AUDIO_JOB_PREFIX):]
+    output = AUDIO_OUTPUTS.get(audio_format)
+
+    with JobWorkspace() as workspace:
+        try:
+            source = pick_audio_source(video_info, audio_format)
+            source_path = workspace.file(f"source.{source.ext or 'bin'}")
+            await timed_download(video_info, "audio", source.format_id, source_path, workspace, progress)
+
+            path, mime_type = source_path, AUDIO_SOURCE_MIME.get(source.ext, "application/octet-stream")
+            same_codec = output is not None and source.acodec.lower().startswith(output["codecs"])
+            if output is not None and not (same_codec and source.ext == output["ext"]):
+                # Same codec in another container is a remux; only a codec change is encoded
+                path, mime_type = workspace.file(f"audio.{output['ext']}"), output["mime"]
+                if progress:
+                    progress.set_stage("converting")
+                returncode, ffmpeg_stderr = await run_ffmpeg(
+                    ["-i", source_path, "-vn", "-map", "0:a:0"]
+                    + (["-c:a", "copy"] if same_codec else output["encode"])
+                    + ["-fs", str(workspace.remaining()), path],
+                    duration=video_info.get('duration'),
+                    on_progress=progress.update_merge if progress else None
+                )
+                if returncode != 0:
+                    logging.error(f"Error converting audio: {ffmpeg_stderr.strip()}")
+                    await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+                    return
+                workspace.charge(path, os.path.getsize(path))
+        except WorkspaceQuotaExceeded as e:
+            logging.error(f"Workspace quota exceeded: {e}")
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, this audio is too large to process.")
+            return
+        except yt_dlp.utils.DownloadError as e:
+            logging.error(f"Error downloading audio: {e}")
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ Sorry, an error occurred while processing your request.")
+            return
+
+        size = os.path.getsize(path)
+        if not fits_upload_limit(size):
+            await send_stream_links(chat_id, link, context, source.format_id, "best_audio", video_info, size)
+            return LinkDelivery(source.format_id, size)
+
+        if progress:
+            progress.set_stage("uploading")
+        await deliver_audio_file(chat_id, link, job_id, path, context, video_info, mime_type)
+
+    add_to_history(chat_id, link, job_id)
+
+# Run a download in this process, or queue it for the workers in frontend mode. The status
+# message is removed when the job is over (for queued jobs, by collect_finished_jobs).
+async def start_download(format_id: str, chat_id: int, link: str, context, selected_quality: str, status_message_id: int, video_info: dict = None):
+    # "Best Quality Audio" goes down the audio pipeline, in the user's chosen audio format
+    if selected_quality == 'best_audio':
+        format_id = audio_job_id(get_user_preference(chat_id, "audio_format"))
+    if BOT_ROLE == "frontend":
+        # Re-sending a file_id is cheap; only real work goes to the workers
+        if not await send_cached_video(chat_id, link, format_id, context, selected_quality):
+            await run_job_queue(_enqueue_job_sync, chat_id, link, format_id, selected_quality, status_message_id)
+            return
+    else:
+        await schedule_youtube_download(format_id, chat_id, link, context, selected_quality, status_message_id, video_info)
+    await context.bot.delete_message(chat_id=chat_id, message_id=status_message_id)
+
+# Frontend: report jobs the workers have finished. Workers deliver the video themselves; the
+# front end learns the file_id for later requests and clears the status message.
+async def collect_finished_jobs(context: ContextTypes.DEFAULT_TYPE):
+    for job in await run_job_queue(_collect_finished_jobs_sync):
+        try:
+            if job["state"] == "done":
+                if job["file_id"]:
+                    remember_file_id(job["link"], job["format_id"], job["file_id"])
+            else:
+                logging.error(f"Job {job['id']} failed: {job['error']}")
+                await context.bot.send_message(chat_id=job["chat_id"], text="⚠️ Sorry, an error occurred while processing your request.")
+            await context.bot.delete_message(chat_id=job["chat_id"], message_id=job["status_message_id"])
+        except TelegramError as e:
+            logging.warning(f"Failed to report job {job['id']}: {e}")
+
+# Workers call the same job code as the bot; this stands in for the handler context
+WorkerContext = namedtuple("WorkerContext", "bot")
+
+async def execute_job(job: dict, worker_id: str, context: WorkerContext):
+    try:
+        await schedule_youtube_download(job["format_id"], job["chat_id"], job["link"], context, job["quality"], job["status_message_id"])
+    except Exception as e:
+        logging.error(f"Job {job['id']} failed: {e}")
+        await run_job_queue(_finish_job_sync, job["id"], worker_id, "failed", None, str(e))
+        return
+    file_id = get_file_id(job["link"], job["format_id"])
+    await run_job_queue(_finish_job_sync, job["id"], worker_id, "done", file_id, None)
+
+# Worker process: claim queued jobs, up to WORKER_CONCURRENCY at a time, and keep their leases alive.
+# A worker that crashes loses only its lease; its jobs go back to the queue.
+async def run_worker():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    bot_options = {"request": HTTPXRequest(connection_pool_size=WORKER_CONCURRENCY * 4)}
+    if BOT_API_BASE_URL:
+        bot_options.update(base_url=BOT_API_BASE_URL, local_mode=BOT_API_LOCAL_MODE)
+        if BOT_API_BASE_FILE_URL:
+            bot_options["base_file_url"] = BOT_API_BASE_FILE_URL
+    running = {}  # task -> job id
+    last_heartbeat = time.monotonic()
+
+    async with Bot(TELEGRAM_BOT_TOKEN, **bot_options) as bot:
+        context = WorkerContext(bot)
+        logging.warning(f"Worker {worker_id} processing jobs from {JOB_QUEUE_DB}")
+        try:
+            while True:
+                job = await run_job_queue(_claim_job_sync, worker_id) if len(running) < WORKER_CONCURRENCY else None
+                if job is not None:
+                    running[asyncio.create_task(execute_job(job, worker_id, context))] = job["id"]
+                    continue
+
+                if running:
+                    done, _ = await asyncio.wait(running, timeout=JOB_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        running.pop(task)
+                else:
+                    await asyncio.sleep(JOB_POLL_INTERVAL)
+
+                if running and time.monotonic() - last_heartbeat >= JOB_LEASE / 4:
+                    await run_job_queue(_heartbeat_jobs_sync, worker_id, list(running.values()))
+                    last_heartbeat = time.monotonic()
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            await close_http_client()
+            HISTORY_EXECUTOR.shutdown(wait=True)
+
 # Message handler for YouTube/Instagram links
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     text = update.message.text
 
-    if not is_valid_link(text):
+    route = route_link(text)
+    if route is None:
         await context.bot.send_message(chat_id=chat_id, text="🚫 Invalid link. Please send a valid *YouTube* or *Instagram* link.", parse_mode='Markdown')
         return
 
-    link = normalize_url(text)
+    link = route.url
 
-    if "instagram.com" in link:
+    if route.platform == "instagram":
         message = await context.bot.send_message(chat_id=chat_id, text="🔍 Fetching your download link, please wait...")
         await send_instagram_download_link(chat_id, link, context)
         await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
     else:
         message = await context.bot.send_message(chat_id=chat_id, text="🔍 Fetching available formats, please wait...")
-        formats = await fetch_formats(link)
+        video_info = await fetch_video_info(link)
+        formats = fetch_formats(video_info) if video_info else None
 
         if not formats:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Failed to fetch available formats. Please try again.", parse_mode='Markdown')
@@ -335,19 +2186,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         default_quality = get_user_preference(chat_id, "default_quality")
 
-        # Filter and organize available formats
-        desired_resolutions = ['144p', '240p', '360p', '480p', '720p', '1080p']
-        filtered_formats = {}
+        # Best available format for each quality tier
+        best_formats = best_formats_by_tier(formats)
+        filtered_formats = {quality: fmt.format_id for quality, fmt in best_formats.items()}
 
-        for format_id, resolution in formats:
-            for quality in desired_resolutions:
-                if quality in resolution and 'mp4' in resolution:
-                    filtered_formats[quality] = format_id
-                elif quality in resolution and 'webm' in resolution and quality not in filtered_formats:
-                    filtered_formats[quality] = format_id
-            if 'audio only' in resolution:
-                if 'best_audio' not in filtered_formats or 'DRC' not in resolution:
-                    filtered_formats['best_audio'] = format_id
+        # Tiers predicted to exceed the upload limit are still offered, but delivered as links
+        duration = video_info.get('duration')
+        link_only = {
+            quality for quality, fmt in best_formats.items()
+            if not fits_upload_limit(estimate_merged_size(fmt, best_formats.get('best_audio'), duration))
+        }
 
         # Check if user's default quality is available
         if default_quality and default_quality in filtered_formats:
@@ -358,20 +2206,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text=f"🎥 Using your default preference: *{default_quality}*. Generating download link...",
                 parse_mode='Markdown'
             )
-            await send_youtube_download_link(format_id, chat_id, link, context, default_quality)
-            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            await start_download(format_id, chat_id, link, context, default_quality, message.message_id, video_info)
             return
 
-        # Cache unique ID and formats
+        # Remember the link and formats behind this keyboard
         unique_id = str(uuid.uuid4())
-        URL_CACHE[unique_id] = link
-        FORMAT_CACHE[unique_id] = filtered_formats
+        SELECTION_SESSIONS.set(unique_id, {"link": link, "formats": filtered_formats})
 
         # Generate buttons for available formats
         keyboard = []
         row = []
         for resolution, format_id in filtered_formats.items():
             button_text = "Best Quality Audio" if resolution == 'best_audio' else resolution
+            if resolution in link_only:
+                button_text += " 🔗"
             row.append(InlineKeyboardButton(button_text, callback_data=f"{format_id}|{unique_id}|{resolution}"))
             if len(row) == 2:
                 keyboard.append(row)
@@ -385,7 +2233,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.edit_message_text(
             chat_id=chat_id,
             message_id=message.message_id,
-            text="🎥 Select the desired format for your download:",
+            text="🎥 Select the desired format for your download:" + (
+                "\n🔗 _Too large for Telegram, you'll get a download link._" if link_only else ""
+            ),
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
@@ -401,26 +2251,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Function to show history with pagination
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    history = load_history()
-
-    # Check if user has any history
-    user_history = history.get(str(chat_id), [])
-    if not user_history:
-        await context.bot.send_message(chat_id=chat_id, text="📜 No download history found!")
-        return
 
     # Send the first page
-    await send_history_page(chat_id, user_history, 0, context)
+    await send_history_page(chat_id, 0, context)
 
 # Function to send history page with pagination
-async def send_history_page(chat_id: int, history: list, page: int, context):
+async def send_history_page(chat_id: int, page: int, context):
     items_per_page = 5
-    start = page * items_per_page
-    end = start + items_per_page
-    current_page_items = history[start:end]
+    current_page_items, total = await fetch_history_page(chat_id, page, items_per_page)
+    end = page * items_per_page + len(current_page_items)
+
+    # Check if user has any history
+    if not total:
+        await context.bot.send_message(chat_id=chat_id, text="📜 No download history found!")
+        return
 
     # Generate the message
-    message = f"📜 *Your Download History (Page {page + 1}/{(len(history) - 1) // items_per_page + 1})*:\n\n"
+    message = f"📜 *Your Download History (Page {page + 1}/{(total - 1) // items_per_page + 1})*:\n\n"
     for entry in current_page_items:
         message += f"🔗 *URL*: {entry['url']}\n🎥 *Format*: {entry['format']}\n📅 *Time*: {entry['timestamp']}\n\n"
 
@@ -428,7 +2275,7 @@ async def send_history_page(chat_id: int, history: list, page: int, context):
     keyboard = []
     if page > 0:  # Add "Previous" button if not on the first page
         keyboard.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"history|{page - 1}"))
-    if end < len(history):  # Add "Next" button if not on the last page
+    if end < total:  # Add "Next" button if not on the last page
         keyboard.append(InlineKeyboardButton("➡️ Next", callback_data=f"history|{page + 1}"))
 
     reply_markup = InlineKeyboardMarkup([keyboard]) if keyboard else None
@@ -439,7 +2286,6 @@ async def send_history_page(chat_id: int, history: list, page: int, context):
 # Callback query handler for format selection
 async def handle_format_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
 
     data = query.data.split("|")
     if len(data) == 3:
@@ -448,12 +2294,22 @@ async def handle_format_selection(update: Update, context: ContextTypes.DEFAULT_
         selected_quality = data[2]
         chat_id = query.message.chat_id
 
-        if unique_id in URL_CACHE:
-            await context.bot.edit_message_text(chat_id=chat_id, message_id=query.message.message_id, text="📥 Generating your download link, please wait...", parse_mode='Markdown')
-            await send_youtube_download_link(format_code, chat_id, URL_CACHE[unique_id], context, selected_quality)
-            await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
-        else:
+        session = SELECTION_SESSIONS.get(unique_id)
+        if session is None:
+            await query.answer("⌛ This selection has expired. Please send the link again.", show_alert=True)
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=query.message.message_id, text="⌛ This selection has expired. Please send the link again.")
+            return
+
+        await query.answer()
+        if format_code not in session["formats"].values():
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Error: Invalid selection. Please try again.", parse_mode='Markdown')
+            return
+
+        link = session["link"]
+        await context.bot.edit_message_text(chat_id=chat_id, message_id=query.message.message_id, text="📥 Generating your download link, please wait...", parse_mode='Markdown')
+        await start_download(format_code, chat_id, link, context, selected_quality, query.message.message_id)
+    else:
+        await query.answer()
 
 # Callback query handler for pagination (Previous/Next)
 async def handle_history_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -464,22 +2320,26 @@ async def handle_history_pagination(update: Update, context: ContextTypes.DEFAUL
     if data[0] == "history":
         page = int(data[1])
         chat_id = query.message.chat_id
-        history = load_history().get(str(chat_id), [])
 
-        await send_history_page(chat_id, history, page, context)
+        await send_history_page(chat_id, page, context)
 
 async def set_default(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     args = context.args
 
     if len(args) != 1:
-        await context.bot.send_message(chat_id=chat_id, text="❌ Usage: /setdefault <quality>\n\nExample: /setdefault *720p* or /setdefault *best_audio*", parse_mode='Markdown')
+        await context.bot.send_message(chat_id=chat_id, text="❌ Usage: /setdefault <quality> or /setdefault <audio format>\n\nExample: /setdefault *720p*, /setdefault *best_audio* or /setdefault *mp3*", parse_mode='Markdown')
         return
 
     quality = args[0].lower()
+    if quality in AUDIO_OUTPUTS:
+        set_user_preference(chat_id, "audio_format", quality)
+        await context.bot.send_message(chat_id=chat_id, text=f"✅ Audio downloads will be sent as *{quality}*.", parse_mode='Markdown')
+        return
+
     valid_qualities = ['144p', '240p', '360p', '480p', '720p', '1080p', 'best_audio']
     if quality not in valid_qualities:
-        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ Invalid quality. Please choose one of the following: {', '.join(valid_qualities)}")
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ Invalid quality. Please choose one of the following: {', '.join(valid_qualities + list(AUDIO_OUTPUTS))}")
         return
 
     set_user_preference(chat_id, "default_quality", quality)
@@ -488,26 +2348,112 @@ async def set_default(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_default(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     default_quality = get_user_preference(chat_id, "default_quality", "None set")
+    audio_format = get_user_preference(chat_id, "audio_format", "original")
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"📋 Your default download quality is: *{default_quality}*.",
+        text=f"📋 Your default download quality is: *{default_quality}*.\n🎧 Audio format: *{audio_format}*.",
         parse_mode='Markdown'
     )
 
 async def delete_default(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    preferences = load_preferences()
 
-    if str(chat_id) in preferences and "default_quality" in preferences[str(chat_id)]:
-        del preferences[str(chat_id)]["default_quality"]
-        save_preferences(preferences)
+    # /deletedefault audio resets the audio format; plain /deletedefault the quality
+    if context.args and context.args[0].lower() == "audio":
+        if delete_user_preference(chat_id, "audio_format"):
+            await context.bot.send_message(chat_id=chat_id, text="🗑 Audio format setting has been deleted.", parse_mode='Markdown')
+        else:
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ No audio format setting found to delete.")
+        return
+
+    if delete_user_preference(chat_id, "default_quality"):
         await context.bot.send_message(chat_id=chat_id, text="🗑 Default quality setting has been deleted.", parse_mode='Markdown')
     else:
         await context.bot.send_message(chat_id=chat_id, text="⚠️ No default quality setting found to delete.")
 
+# Admin command to report cache effectiveness
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        return
+
+    stats = METADATA_CACHE.stats()
+    throughput = UPLOAD_STATS['bytes'] / UPLOAD_STATS['seconds'] / 1024 / 1024 if UPLOAD_STATS['seconds'] else 0
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f"📊 *Metadata cache*\n"
+            f"Entries: {stats['entries']}/{METADATA_CACHE.max_entries}\n"
+            f"Hits: {stats['hits']} | Misses: {stats['misses']}\n"
+            f"Hit rate: {stats['hit_rate']:.0%}\n\n"
+            f"📤 *Uploads*\n"
+            f"Sent: {UPLOAD_STATS['uploads']} ({UPLOAD_STATS['bytes'] / 1024 / 1024:.0f} MB) | "
+            f"Retries: {UPLOAD_STATS['retries']} | Failed: {UPLOAD_STATS['failures']}\n"
+            f"Throughput: {throughput:.2f} MB/s"
+        ),
+        parse_mode='Markdown'
+    )
+
+# Periodically persist pending selection keyboards
+async def flush_selection_sessions(context: ContextTypes.DEFAULT_TYPE):
+    # Take the snapshot on the event loop so the worker thread never sees a dict mid-update
+    await asyncio.to_thread(SELECTION_SESSIONS.write, SELECTION_SESSIONS.snapshot())
+
+# Background loops run as plain asyncio tasks on the bot's event loop: PTB's job queue
+# needs the optional APScheduler extra, which this bot doesn't depend on.
+# (callback, interval) pairs registered in main(); callbacks get the app as their context.
+PERIODIC_CALLBACKS = []
+PERIODIC_TASKS = []
+
+async def run_periodically(callback, interval: float, app: Application):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await callback(app)
+        except Exception as e:
+            logging.error(f"{callback.__name__} failed: {e}")
+
+# Start the background loops once the bot is initialized
+async def on_startup(app: Application):
+    for callback, interval in PERIODIC_CALLBACKS:
+        PERIODIC_TASKS.append(asyncio.create_task(run_periodically(callback, interval, app)))
+
+# Persist pending state on shutdown
+async def on_shutdown(app: Application):
+    for task in PERIODIC_TASKS:
+        task.cancel()
+    await asyncio.gather(*PERIODIC_TASKS, return_exceptions=True)
+    PERIODIC_TASKS.clear()
+    SELECTION_SESSIONS.flush()
+    await flush_preferences()
+    await flush_file_ids()
+    await close_http_client()
+    HISTORY_EXECUTOR.shutdown(wait=True)
+
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    FILE_ID_CACHE.update(load_file_ids())
+    _trim_file_ids()
+    ARTIFACT_CACHE.load()
+    if BOT_ROLE == "worker":
+        asyncio.run(run_worker())
+        return
+
+    SELECTION_SESSIONS.load()
+    get_preferences()
+    # Updates are handled concurrently; the download scheduler bounds the heavy work
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).post_init(on_startup).post_shutdown(on_shutdown)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL).local_mode(BOT_API_LOCAL_MODE)
+        if BOT_API_BASE_FILE_URL:
+            builder = builder.base_file_url(BOT_API_BASE_FILE_URL)
+    app = builder.build()
+    if SELECTION_SESSION_FILE:
+        PERIODIC_CALLBACKS.append((flush_selection_sessions, SELECTION_FLUSH_INTERVAL))
+    PERIODIC_CALLBACKS.append((flush_preferences, PREFERENCE_FLUSH_INTERVAL))
+    PERIODIC_CALLBACKS.append((flush_file_ids, FILE_ID_FLUSH_INTERVAL))
+    if BOT_ROLE == "frontend":
+        PERIODIC_CALLBACKS.append((collect_finished_jobs, JOB_POLL_INTERVAL))
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -517,8 +2463,21 @@ def main():
     app.add_handler(CommandHandler("setdefault", set_default))
     app.add_handler(CommandHandler("getdefault", get_default))
     app.add_handler(CommandHandler("deletedefault", delete_default))
-
-    app.run_polling()
+    app.add_handler(CommandHandler("cachestats", cache_stats))
+
+    if WEBHOOK_URL:
+        if not WEBHOOK_SECRET_TOKEN:
+            logging.warning("WEBHOOK_SECRET_TOKEN is not set; anyone who finds the webhook URL can post updates")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
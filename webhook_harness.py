@@ -0,0 +1,66 @@
+"""Post fake Telegram updates to the bot's webhook: python webhook_harness.py [options] [link ...]
+
+Run the bot in webhook mode against the stub server, e.g.
+
+    python stub_bot_api.py 8081 &
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot WEBHOOK_URL=http://127.0.0.1:8443 \\
+        WEBHOOK_LISTEN=127.0.0.1 WEBHOOK_SECRET_TOKEN=harness python video_bot.py &
+    python webhook_harness.py --secret harness --copies 20 https://youtu.be/dQw4w9WgXcQ
+
+then watch the stub's log for the bot's replies. The harness sends /start, each link
+(--copies times, all at once, to exercise concurrent delivery) and one update with a
+wrong secret, which the bot must reject with 403.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+
+UPDATE_IDS = itertools.count(1)
+
+def message_update(chat_id: int, text: str) -> dict:
+    update_id = next(UPDATE_IDS)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Harness"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+async def post_update(client: httpx.AsyncClient, url: str, secret: str, update: dict) -> tuple:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    started = time.monotonic()
+    response = await client.post(url, json=update, headers=headers)
+    return response.status_code, time.monotonic() - started
+
+async def main(args):
+    async with httpx.AsyncClient(timeout=30) as client:
+        status, elapsed = await post_update(client, args.url, args.secret, message_update(args.chat, "/start"))
+        print(f"/start -> {status} in {elapsed * 1000:.0f} ms")
+
+        for link in args.links:
+            updates = [message_update(args.chat + i, link) for i in range(args.copies)]
+            started = time.monotonic()
+            results = await asyncio.gather(*(post_update(client, args.url, args.secret, u) for u in updates))
+            statuses = sorted({status for status, _ in results})
+            slowest = max(elapsed for _, elapsed in results)
+            print(f"{link} x{args.copies} -> {statuses} in {time.monotonic() - started:.2f}s (slowest {slowest * 1000:.0f} ms)")
+
+        if args.secret:
+            status, _ = await post_update(client, args.url, args.secret + "-wrong", message_update(args.chat, "/start"))
+            print(f"wrong secret -> {status} ({'rejected' if status == 403 else 'NOT rejected'})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("links", nargs="*", default=["https://www.youtube.com/watch?v=dQw4w9WgXcQ"])
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram", help="webhook endpoint")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET_TOKEN of the bot")
+    parser.add_argument("--chat", type=int, default=1000, help="chat ID of the first fake user")
+    parser.add_argument("--copies", type=int, default=1, help="concurrent copies of each link update")
+    asyncio.run(main(parser.parse_args()))